@@ -0,0 +1,395 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+#
+# Copyright (c) 2016 the authors of the https://github.com/publicdocs project.
+# Use of this file is subject to the NOTICE file in the root of the repository.
+#
+
+# Benchmarks for process_xml.py. Each title of a release point ZIP is taken
+# through the same stages as process_title, timed separately: hashing the ZIP
+# (process_zip), parsing, rendering (process_element), splitting the outputs
+# into files with their prev/next links (title_writer), and writing the files.
+# There are also micro-benchmarks of the escaping functions. The XML parser
+# is chosen with --parser as for process_xml.py; --parser=all also compares
+# parsing and rendering with each installed parser.
+#
+# Without --i, a synthetic USLM release point is generated first, so nothing
+# has to be downloaded; its shape is set with the --sections ... options.
+#
+# The results can be saved with --report, and compared against an earlier
+# report with --baseline: any stage that got slower by more than --threshold
+# is reported, and the exit status is 1. The micro-benchmarks (escaping, and
+# rendering per element) are too noisy for that; their slowdowns are only
+# reported.
+#
+# Examples:
+#   python benchmark.py --report=bench.json
+#   python benchmark.py --baseline=bench.json
+#   python benchmark.py --i=../../Downloads/xml_uscAll@114-195.zip --titles 42
+#   python benchmark.py --parser=all
+
+import argparse
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import zipfile
+
+from collections import namedtuple
+
+import process_xml
+
+STAGES = ["hash", "parse", "render", "split", "write"]
+
+# The shape of a synthetic release point; see the --sections ... options.
+CorpusShape = namedtuple("CorpusShape", "titles chapters sections depth fanout tables layouts footnotes refs quoted seed")
+
+_small_levels = ["subsection", "paragraph", "subparagraph", "clause", "subclause", "item", "subitem", "subsubitem"]
+
+def synthetic_num(level, i):
+    if level == 1:
+        return u"(%d)" % (i + 1)
+    if level == 2:
+        return u"(%s)" % chr(ord('A') + i % 26)
+    return u"(%s)" % chr(ord('a') + i % 26)
+
+def synthetic_text(r, shape, t, out):
+    out.append(u"Text with some_words and [brackets] in it")
+    if r.random() < shape.refs:
+        out.append(u' <ref href="/us/usc/t%d/s%d">section %d of this title</ref>' % (t, r.randint(1, 500), r.randint(1, 500)))
+    if r.random() < shape.footnotes:
+        out.append(u'<ref class="footnoteRef" idref="fn%d">1</ref><note type="footnote" id="fn%d"><num>1</num> See note.</note>' % (r.randint(1, 999999), r.randint(1, 999999)))
+    out.append(u" and more text.")
+
+def synthetic_level(r, shape, t, ident, level, i, out):
+    tag = _small_levels[level]
+    ident = ident + u"/" + synthetic_num(level, i).strip(u"()")
+    out.append(u'<%s identifier="%s" class="indent%d"><num>%s</num>' % (tag, ident, level + 1, synthetic_num(level, i)))
+    if level + 1 < shape.depth:
+        out.append(u"<chapeau>")
+        synthetic_text(r, shape, t, out)
+        out.append(u"</chapeau>")
+        for j in xrange(shape.fanout):
+            synthetic_level(r, shape, t, ident, level + 1, j, out)
+    else:
+        out.append(u"<content>")
+        synthetic_text(r, shape, t, out)
+        if r.random() < shape.quoted:
+            out.append(u'<quotedContent><section><num>§ 1.</num><heading>Quoted</heading><content><p>Quoted text with *stars*.</p></content></section></quotedContent>')
+        out.append(u"</content>")
+    out.append(u"</%s>" % tag)
+
+def synthetic_section(r, shape, t, s, out):
+    ident = u"/us/usc/t%d/s%d" % (t, s)
+    out.append(u'<section identifier="%s"><num>§ %d.</num><heading>Section %d heading</heading>' % (ident, s, s))
+    if shape.depth > 0:
+        for j in xrange(shape.fanout):
+            synthetic_level(r, shape, t, ident, 0, j, out)
+    else:
+        out.append(u"<content>")
+        synthetic_text(r, shape, t, out)
+        out.append(u"</content>")
+    if r.random() < shape.tables:
+        out.append(u'<xhtml:table><xhtml:colgroup/><xhtml:thead><xhtml:tr><xhtml:th colspan="2">Heading &amp; more</xhtml:th></xhtml:tr></xhtml:thead><xhtml:tbody>')
+        for k in xrange(5):
+            out.append(u'<xhtml:tr><xhtml:td>Row %d</xhtml:td><xhtml:td>Value "%d" &lt; limit</xhtml:td></xhtml:tr>' % (k, k))
+        out.append(u'</xhtml:tbody></xhtml:table>')
+    if r.random() < shape.layouts:
+        out.append(u'<layout><header><column>Sec.</column><column colspan="2">Title</column></header>')
+        for k in xrange(5):
+            out.append(u'<tocItem><column>%d.</column><column>Entry_%d</column></tocItem>' % (k, k))
+        out.append(u'</layout>')
+    out.append(u'<notes><note><heading>Amendments</heading><p class="indent0">Pub. L. 1-1 amended this section.</p></note></notes>')
+    out.append(u"</section>\n")
+
+def synthetic_title(shape, t):
+    r = random.Random(shape.seed * 1000 + t)
+    out = [u'<?xml version="1.0" encoding="UTF-8"?>\n<uscDoc xmlns="http://xml.house.gov/schemas/uslm/1.0" xmlns:xhtml="http://www.w3.org/1999/xhtml" identifier="/us/usc/t%d">' % t]
+    out.append(u'<meta><dc:title xmlns:dc="http://purl.org/dc/elements/1.1/">Title %d</dc:title></meta><main>' % t)
+    out.append(u'<title identifier="/us/usc/t%d"><num>Title %d—</num><heading>Synthetic</heading>' % (t, t))
+    s = 1
+    for c in xrange(shape.chapters):
+        out.append(u'<chapter identifier="/us/usc/t%d/ch%d"><num>CHAPTER %d—</num><heading>Chapter %d</heading>' % (t, c + 1, c + 1, c + 1))
+        for i in xrange(shape.sections / shape.chapters):
+            synthetic_section(r, shape, t, s, out)
+            s = s + 1
+        out.append(u"</chapter>")
+    out.append(u"</title></main></uscDoc>\n")
+    return u"".join(out).encode("utf-8")
+
+def write_synthetic_zip(path, shape):
+    z = zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED)
+    titles = []
+    for t in xrange(1, shape.titles + 1):
+        title = u"%02d" % t
+        z.writestr("xml/usc" + title + ".xml", synthetic_title(shape, t))
+        titles.append(title)
+    z.close()
+    return titles
+
+# Records what title_writer would write, so splitting and writing can be
+# timed separately.
+class recording_writer(process_xml.title_writer):
+    def __init__(self, *args):
+        process_xml.title_writer.__init__(self, *args)
+        self.recorded = []
+
+    def write(self, outs):
+        self.recorded.append(outs)
+
+    def write_recorded(self):
+        for outs in self.recorded:
+            process_xml.title_writer.write(self, outs)
+
+def bench_title(zipinfo, title, wd):
+    times = {}
+    started = time.time()
+    f = process_xml.open_title_xml(zipinfo, u"usc" + title + u".xml")
+    root = process_xml._xml.parse(f)
+    f.close()
+    times["parse"] = time.time() - started
+    elements = sum(1 for e in root.iter())
+
+    started = time.time()
+    p = process_xml.process_element(root, False, False)
+    times["render"] = time.time() - started
+    root = None
+
+    wdir = wd + u"/gen/titles/usc" + title
+    if os.path.exists(wdir):
+        shutil.rmtree(wdir)
+    os.makedirs(wdir)
+    started = time.time()
+    writer = recording_writer(wdir, title, title, title + u" U.S.C.")
+    for o in p.outputmd:
+        writer.add(o)
+    writer.close()
+    times["split"] = time.time() - started
+
+    started = time.time()
+    writer.write_recorded()
+    times["write"] = time.time() - started
+    return times, elements, writer.count
+
+# Parsing and rendering each title with every installed parser, both from a
+# whole tree and streamed.
+def bench_parsers(zipinfo, titles, repeat):
+    results = {}
+    current = process_xml._xml.name
+    for name in process_xml.xml_backend_names():
+        xml = process_xml.use_xml_backend(name)
+        totals = {"parse": 0.0, "render": 0.0, "stream": 0.0}
+        for title in titles:
+            best = {}
+            for i in xrange(repeat):
+                started = time.time()
+                f = process_xml.open_title_xml(zipinfo, u"usc" + title + u".xml")
+                root = xml.parse(f)
+                f.close()
+                t = {"parse": time.time() - started}
+                started = time.time()
+                process_xml.process_element(root, False, False)
+                t["render"] = time.time() - started
+                root = None
+                started = time.time()
+                f = process_xml.open_title_xml(zipinfo, u"usc" + title + u".xml")
+                for o in process_xml.stream_title(f, []):
+                    pass
+                f.close()
+                t["stream"] = time.time() - started
+                for stage in t:
+                    best[stage] = min(best.get(stage, t[stage]), t[stage])
+            for stage in best:
+                totals[stage] = totals[stage] + best[stage]
+        results[name] = totals
+        print "Parser %-12s parse %.3fs, render %.3fs, streamed parse and render %.3fs" % (name, totals["parse"], totals["render"], totals["stream"])
+    process_xml.use_xml_backend(current)
+    return results
+
+def best_of(repeat, number, fn):
+    best = None
+    for i in xrange(repeat):
+        started = time.time()
+        for j in xrange(number):
+            fn()
+        t = (time.time() - started) / number
+        if best is None or t < best:
+            best = t
+    return best
+
+def bench_escape(repeat):
+    results = {}
+    texts = [
+        ("short", u"Subsection text ", 100000),
+        ("marked", u"as defined in section 101(a)(1)_[x]", 100000),
+        ("long", u"Some ordinary statutory text with a_b and [brackets] here. " * 200, 200),
+    ]
+    for name, txt, number in texts:
+        results["md_escape_" + name] = best_of(repeat, number, lambda: process_xml.md_escape(txt))
+        results["html_escape_" + name] = best_of(repeat, number, lambda: process_xml.html_escape(txt))
+    return results
+
+def run(input_zip, titles, repeat, wd, parsers=False):
+    report = {"titles": {}, "stages": {}, "escape": bench_escape(repeat), "parser": process_xml._xml.name}
+    for i in xrange(repeat):
+        started = time.time()
+        zipinfo = process_xml.process_zip(open(input_zip, "rb"), wd)
+        t = time.time() - started
+        report["stages"]["hash"] = min(report["stages"].get("hash", t), t)
+    for title in titles:
+        best = None
+        for i in xrange(repeat):
+            times, elements, count = bench_title(zipinfo, title, wd)
+            if best is None:
+                best = times
+            for stage in times:
+                best[stage] = min(best[stage], times[stage])
+        report["titles"][title] = {"elements": elements, "files": count, "stages": best}
+        print "Title %s: %d elements, %d files, %s" % (title, elements, count,
+                u", ".join([u"%s %.3fs" % (s, best[s]) for s in STAGES if s in best]))
+    elements = 0
+    for title in report["titles"]:
+        r = report["titles"][title]
+        elements = elements + r["elements"]
+        for stage in r["stages"]:
+            report["stages"][stage] = report["stages"].get(stage, 0.0) + r["stages"][stage]
+    report["elements"] = elements
+    report["render_us_per_element"] = report["stages"]["render"] / max(1, elements) * 1e6
+    if parsers:
+        report["parsers"] = bench_parsers(zipinfo, titles, repeat)
+    return report
+
+# Returns the measurements that are more than threshold slower than in the
+# baseline report. Only the stages are gating, and those under min_seconds in
+# both are too noisy to compare; the micro-benchmarks are returned with gating
+# False.
+def regressions(report, baseline, threshold, min_seconds):
+    found = []
+    pairs = []
+    for stage in STAGES:
+        if stage in baseline.get("stages", {}) and stage in report["stages"]:
+            pairs.append((u"stage " + stage, baseline["stages"][stage], report["stages"][stage], True))
+    if "render_us_per_element" in baseline:
+        pairs.append((u"render per element", baseline["render_us_per_element"], report["render_us_per_element"], False))
+    for name in sorted(baseline.get("escape", {})):
+        if name in report["escape"]:
+            pairs.append((name, baseline["escape"][name], report["escape"][name], False))
+    for name, before, now, gating in pairs:
+        if gating and max(before, now) < min_seconds:
+            continue
+        if before > 0 and now > before * (1 + threshold):
+            found.append({"name": name, "baseline": before, "now": now, "ratio": now / before, "gating": gating})
+    return found
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks the generation of publicdocs project US Code files.')
+    parser.add_argument('--i', dest='input_zip', action='store',
+                        help='ZIP file of a release point; by default a synthetic one is generated')
+    parser.add_argument('--titles', dest='titles', nargs='*',
+                        help='titles to benchmark, by default all of the synthetic ones')
+    parser.add_argument('--wd', dest='working_directory', action='store',
+                        help='working directory for the generated files; by default a temporary one that is removed afterwards')
+    parser.add_argument('--repeat', dest='repeat', action='store', type=int, default=3,
+                        help='runs of each benchmark; the best one is reported')
+    parser.add_argument('--report', dest='report', action='store',
+                        help='path to write the results to, as JSON')
+    parser.add_argument('--baseline', dest='baseline', action='store',
+                        help='JSON report of an earlier run to compare against')
+    parser.add_argument('--threshold', dest='threshold', action='store', type=float, default=0.25,
+                        help='slowdown relative to the baseline that counts as a regression, e.g. 0.25 for 25%%')
+    parser.add_argument('--min-seconds', dest='min_seconds', action='store', type=float, default=0.05,
+                        help='stages faster than this in both runs are not compared')
+    parser.add_argument('--synthetic-titles', dest='synthetic_titles', action='store', type=int, default=2,
+                        help='number of synthetic titles')
+    parser.add_argument('--chapters', dest='chapters', action='store', type=int, default=4,
+                        help='chapters per synthetic title')
+    parser.add_argument('--sections', dest='sections', action='store', type=int, default=400,
+                        help='sections per synthetic title')
+    parser.add_argument('--depth', dest='depth', action='store', type=int, default=4,
+                        help='levels below each section, from subsection (1) down to subsubitem (8)')
+    parser.add_argument('--fanout', dest='fanout', action='store', type=int, default=2,
+                        help='children of each section and of each level above the deepest')
+    parser.add_argument('--tables', dest='tables', action='store', type=float, default=0.05,
+                        help='fraction of sections with an xhtml table')
+    parser.add_argument('--layouts', dest='layouts', action='store', type=float, default=0.05,
+                        help='fraction of sections with a layout')
+    parser.add_argument('--footnotes', dest='footnotes', action='store', type=float, default=0.1,
+                        help='chance of a footnote in each text')
+    parser.add_argument('--refs', dest='refs', action='store', type=float, default=0.3,
+                        help='chance of a ref in each text')
+    parser.add_argument('--quoted', dest='quoted', action='store', type=float, default=0.05,
+                        help='chance of quotedContent in each of the deepest levels')
+    parser.add_argument('--seed', dest='seed', action='store', type=int, default=1,
+                        help='seed for the synthetic release point')
+    parser.add_argument('--parser', dest='parser', action='store', choices=['auto', 'all'] + process_xml.XML_PARSERS, default='auto',
+                        help='XML parser to benchmark with; all also compares every installed parser')
+    args = parser.parse_args()
+
+    if args.depth < 0 or args.depth > len(_small_levels):
+        print u"(FATAL) #### --depth must be between 0 and " + unicode(len(_small_levels))
+        sys.exit(2)
+    if args.parser in process_xml.XML_PARSERS:
+        process_xml.use_xml_backend(args.parser)
+    wd = args.working_directory
+    tmp = None
+    if not wd:
+        tmp = tempfile.mkdtemp(prefix='uscbench')
+        wd = tmp
+    try:
+        report = {"version": 1, "created": time.time(), "repeat": args.repeat}
+        if args.input_zip:
+            input_zip = args.input_zip
+            titles = args.titles or ["01"]
+        else:
+            shape = CorpusShape(titles = args.synthetic_titles, chapters = max(1, args.chapters), sections = args.sections,
+                    depth = args.depth, fanout = args.fanout, tables = args.tables, layouts = args.layouts,
+                    footnotes = args.footnotes, refs = args.refs, quoted = args.quoted, seed = args.seed)
+            input_zip = wd + "/synthetic.zip"
+            started = time.time()
+            titles = write_synthetic_zip(input_zip, shape)
+            print "Generated %d synthetic titles in %.1fs" % (len(titles), time.time() - started)
+            titles = args.titles or titles
+            report["shape"] = shape._asdict()
+        report["input"] = os.path.basename(input_zip)
+        report["input_bytes"] = os.path.getsize(input_zip)
+        report.update(run(input_zip, titles, args.repeat, wd, args.parser == 'all'))
+    finally:
+        if tmp:
+            shutil.rmtree(tmp)
+
+    for stage in STAGES:
+        print "%-8s %10.3fs" % (stage, report["stages"][stage])
+    print "render   %10.2f us/element (%d elements)" % (report["render_us_per_element"], report["elements"])
+    for name in sorted(report["escape"]):
+        print "%-20s %8.2f us" % (name, report["escape"][name] * 1e6)
+
+    failed = []
+    if args.baseline:
+        f = open(args.baseline, 'r')
+        baseline = json.load(f)
+        f.close()
+        if baseline.get("shape") != report.get("shape") or baseline.get("input") != report.get("input") or baseline.get("parser", "ElementTree") != report["parser"]:
+            print u"(Non-Fatal) #### The baseline was run on different input; comparing anyway"
+        failed = regressions(report, baseline, args.threshold, args.min_seconds)
+        report["baseline"] = args.baseline
+        report["regressions"] = failed
+        for r in failed:
+            if r["gating"]:
+                print u"(FATAL) #### Regression in %s: %.4g -> %.4g (x%.2f)" % (r["name"], r["baseline"], r["now"], r["ratio"])
+            else:
+                print u"(Non-Fatal) #### Slower %s: %.4g -> %.4g (x%.2f)" % (r["name"], r["baseline"], r["now"], r["ratio"])
+        failed = [r for r in failed if r["gating"]]
+    if args.report:
+        f = open(args.report + '.tmp', 'w')
+        json.dump(report, f, indent=2, sort_keys=True)
+        f.close()
+        os.rename(args.report + '.tmp', args.report)
+    if failed:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -19,6 +19,7 @@
 # find an HTTPS download for these files =(
 #
 
+import sys
 import urllib2
 import urllib
 import hashlib
@@ -29,12 +30,26 @@ import argparse
 import shutil
 import StringIO
 import zipfile
+import json
+import marshal
+import sqlite3
+import time
+import threading
+import subprocess
+import re
+import resource
+import signal
+import cProfile
+import pstats
+import Queue
+import inspect
+import traceback
+import xml.parsers.expat
 
-from xml.sax.saxutils import escape
 from xml.etree import ElementTree
 from string import Template
 from collections import namedtuple
-from multiprocessing import Pool
+from multiprocessing import Pool, cpu_count
 
 ## CONSTANTS
 
@@ -118,11 +133,17 @@ $index
 
 """)
 
+HASH_CHUNK_SIZE = 1 << 20
+# Number of reference URLs remembered by each process, see link_url.
+LINK_CACHE_SIZE = 1 << 16
+
 _download_url_template = Template('http://uscode.house.gov/download/releasepoints/us/pl/$rp1/$rp2/xml_uscAll@$rp1-$rp2.zip')
 
 NBSP = u"\u00A0"
 
 _sp = "{http://xml.house.gov/schemas/uslm/1.0}"
+TAG_USC_DOC = _sp + "uscDoc"
+TAG_MAIN = _sp + "main"
 TAG_META = _sp + "meta"
 
 TAG_APPENDIX = _sp + "appendix"
@@ -145,14 +166,15 @@ TAG_SIGNATURE = _sp + "signature"
 TAG_SECTION = _sp + "section"
 TAG_COURT_RULE = _sp + "courtRule"
 
-TAGS_SECTION_LIKE = [TAG_SECTION, TAG_COURT_RULE]
+TAGS_SECTION_LIKE = frozenset([TAG_SECTION, TAG_COURT_RULE])
 
-TAGS_LARGE = [TAG_APPENDIX, TAG_COMPILED_ACT, TAG_COURT_RULES, TAG_TITLE, TAG_SUBTITLE, TAG_CHAPTER, TAG_SUBCHAPTER, TAG_PART, TAG_SUBPART, TAG_DIVISION, TAG_SUBDIVISION, TAG_ARTICLE, TAG_SUBARTICLE]
+TAGS_LARGE = frozenset([TAG_APPENDIX, TAG_COMPILED_ACT, TAG_COURT_RULES, TAG_TITLE, TAG_SUBTITLE, TAG_CHAPTER, TAG_SUBCHAPTER, TAG_PART, TAG_SUBPART, TAG_DIVISION, TAG_SUBDIVISION, TAG_ARTICLE, TAG_SUBARTICLE])
 
-TAGS_HEADINGS = []
+TAGS_HEADINGS = TAGS_LARGE | TAGS_SECTION_LIKE
 
-TAGS_HEADINGS.extend(TAGS_LARGE)
-TAGS_HEADINGS.extend(TAGS_SECTION_LIKE)
+# In streaming mode, these elements stay open while each of their children is
+# rendered, written and discarded in turn.
+TAGS_STREAM_CONTAINER = frozenset([TAG_USC_DOC, TAG_MAIN]) | TAGS_LARGE
 
 TAG_SUBSECTION = _sp + "subsection"
 TAG_PARAGRAPH = _sp + "paragraph"
@@ -163,10 +185,10 @@ TAG_ITEM = _sp + "item"
 TAG_SUBITEM = _sp + "subitem"
 TAG_SUBSUBITEM = _sp + "subsubitem"
 
-TAGS_SMALL = [TAG_SUBSECTION, TAG_PARAGRAPH, TAG_SUBPARAGRAPH, TAG_CLAUSE, TAG_SUBCLAUSE, TAG_ITEM, TAG_SUBITEM, TAG_SUBSUBITEM]
+TAGS_SMALL = frozenset([TAG_SUBSECTION, TAG_PARAGRAPH, TAG_SUBPARAGRAPH, TAG_CLAUSE, TAG_SUBCLAUSE, TAG_ITEM, TAG_SUBITEM, TAG_SUBSUBITEM])
 
 TAG_HEADING = _sp + "heading"
-TAGS_BOLDEN = [TAG_HEADING]
+TAGS_BOLDEN = frozenset([TAG_HEADING])
 
 TAG_CHAPEAU = _sp + "chapeau"
 TAG_CONTENT = _sp + "content"
@@ -177,11 +199,9 @@ _shtml = "{http://www.w3.org/1999/xhtml}"
 TAG_P = _shtml + "p"
 
 TAG_QUOTEDCONTENT = _sp + "quotedContent"
-TAGS_QUOTED = [TAG_QUOTEDCONTENT]
+TAGS_QUOTED = frozenset([TAG_QUOTEDCONTENT])
 
-TAGS_BREAK = [TAG_CHAPEAU, TAG_CONTINUATION, TAG_P]
-TAGS_BREAK.extend(TAGS_HEADINGS)
-TAGS_BREAK.extend(TAGS_SMALL)
+TAGS_BREAK = frozenset([TAG_CHAPEAU, TAG_CONTINUATION, TAG_P]) | TAGS_HEADINGS | TAGS_SMALL
 
 TAG_NOTE = _sp + "note"
 TAG_REF = _sp + "ref"
@@ -200,16 +220,123 @@ TAG_TBODY = _shtml + "tbody"
 TAG_TFOOT = _shtml + "tfoot"
 TAG_COLGROUP = _shtml + "colgroup"
 
+# What md_renderer does with each tag is looked up once per element in
+# RENDER_KINDS; tags that are not in it are plain containers of text and
+# children.
+RENDER_PLAIN = 0
+RENDER_DIVISION = 1
+RENDER_BREAK = 2
+RENDER_SIGNATURE = 3
+RENDER_BOLDEN = 4
+RENDER_QUOTED = 5
+RENDER_REF = 6
+RENDER_NOTE = 7
+RENDER_META = 8
+RENDER_LAYOUT = 9
+RENDER_TABLE = 10
+
+RENDER_KINDS = {}
+for _t in TAGS_BREAK:
+    RENDER_KINDS[_t] = RENDER_BREAK
+for _t in TAGS_HEADINGS:
+    RENDER_KINDS[_t] = RENDER_DIVISION
+for _t in TAGS_BOLDEN:
+    RENDER_KINDS[_t] = RENDER_BOLDEN
+for _t in TAGS_QUOTED:
+    RENDER_KINDS[_t] = RENDER_QUOTED
+RENDER_KINDS[TAG_SIGNATURE] = RENDER_SIGNATURE
+RENDER_KINDS[TAG_REF] = RENDER_REF
+RENDER_KINDS[TAG_NOTE] = RENDER_NOTE
+RENDER_KINDS[TAG_META] = RENDER_META
+RENDER_KINDS[TAG_LAYOUT] = RENDER_LAYOUT
+RENDER_KINDS[TAG_TABLE] = RENDER_TABLE
+
 ## STRUCTURES
-ZipContents = namedtuple("ZipContents", "sha512 titledir")
+ZipContents = namedtuple("ZipContents", "sha512 zippath titledir")
 ProcessedElement = namedtuple("ProcessedElement", "inputmeta outputmd tail")
 FileDelimiter = namedtuple("FileDelimiter", "identifier dir titleroot reporoot prev next filename uslmid")
 FileDelimiter.__new__.__defaults__ = (None, ) * len(FileDelimiter._fields)
 Link = namedtuple("Link", "refcontent href")
+TitleOptions = namedtuple("TitleOptions", "streaming incremental manifest_dir cache_dir report_dir profile_dir profile_mode fast_import_prefix section_cache parser ir_cache write_queue dedupe_links xref_index fast_import_base")
+TitleOptions.__new__.__defaults__ = (None, ) * len(TitleOptions._fields)
 
 ## FUNCTIONS
 
 # A release point is labeled like Public Law 114-195, i.e. Public Law rp1-rp2
+# The XML parsers that can be used, fastest first; see xml_backend.
+XML_PARSERS = ['cElementTree', 'lxml', 'ElementTree']
+
+# Parses titles with one of XML_PARSERS. They all give elements with the same
+# namespace-qualified tags (see the TAG_ constants), text and tail. Comments
+# and processing instructions are dropped, as ElementTree does. Elements are
+# always serialized by ElementTree, so the meta blobs in the output, and the
+# keys of the section cache, are the same whichever parser is used.
+class xml_backend:
+    def __init__(self, name):
+        self.name = name
+        if name == 'lxml':
+            from lxml import etree
+            self.module = etree
+        elif name == 'cElementTree':
+            from xml.etree import cElementTree
+            self.module = cElementTree
+        elif name == 'ElementTree':
+            self.module = ElementTree
+        else:
+            print u"(FATAL) #### Unknown XML parser " + name
+            assert(False)
+            sys.exit(2)
+
+    def parse(self, source):
+        if self.name == 'lxml':
+            parser = self.module.XMLParser(remove_comments=True, remove_pis=True, huge_tree=True)
+            return self.module.parse(source, parser).getroot()
+        return self.module.parse(source).getroot()
+
+    def iterparse(self, source, events):
+        if self.name == 'lxml':
+            return self.module.iterparse(source, events=events, remove_comments=True, remove_pis=True, huge_tree=True)
+        return self.module.iterparse(source, events=events)
+
+    def tostring(self, elem):
+        if self.name == 'lxml':
+            elem = self.stdlib_copy(elem)
+        return ElementTree.tostring(elem)
+
+    def stdlib_copy(self, elem):
+        e = ElementTree.Element(elem.tag, dict(elem.attrib))
+        e.text = elem.text
+        e.tail = elem.tail
+        for child in elem:
+            e.append(self.stdlib_copy(child))
+        return e
+
+# The first of XML_PARSERS that is installed, unless another is asked for.
+_xml = None
+def use_xml_backend(name=None):
+    global _xml
+    if name is None:
+        for name in XML_PARSERS:
+            try:
+                return use_xml_backend(name)
+            except ImportError:
+                pass
+    if _xml is None or _xml.name != name:
+        _xml = xml_backend(name)
+    return _xml
+
+use_xml_backend()
+
+def xml_backend_names():
+    names = []
+    for name in XML_PARSERS:
+        try:
+            xml_backend(name)
+            names.append(name)
+        except ImportError:
+            pass
+    return names
+
 def download(rp1, rp2):
     # TODO, for now just manually download the file
     return 0
@@ -224,357 +351,666 @@ def md_header_prefix(identifier):
     return (u"#" * c) + u" "
 
 # No links, images, or html tags. Don't auto bold or italics either
-_md_escape_chars = list(u'\\`_{}[]<>*_')
+# Most text has nothing to escape, which the search finds out in one pass; the
+# backslash has to be escaped first.
+_md_escape_re = re.compile(u'[\\\\`_{}\\[\\]<>*]')
+_md_escapes = [(c, u'\\' + c) for c in u'\\`_{}[]<>*']
 def md_escape(txt):
-    ret = u""
-    for c in txt:
-        if c in _md_escape_chars:
-            ret = ret + "\\"
-        ret = ret + c
-    return ret
-
+    txt = unicode(txt)
+    if _md_escape_re.search(txt) is None:
+        return txt
+    for c, e in _md_escapes:
+        if c in txt:
+            txt = txt.replace(c, e)
+    return txt
+
+_md_indent_re = re.compile(u'indent[0-9]')
 def md_indent(clazz):
-    ind = 0
-    if u"indent13" in clazz:
-        ind = 14
-    elif u"indent12" in clazz:
-        ind = 13
-    elif u"indent11" in clazz:
-        ind = 12
-    elif u"indent10" in clazz:
-        ind = 11
-    elif u"indent9" in clazz:
-        ind = 10
-    elif u"indent8" in clazz:
-        ind = 9
-    elif u"indent7" in clazz:
-        ind = 8
-    elif u"indent6" in clazz:
-        ind = 7
-    elif u"indent5" in clazz:
-        ind = 6
-    elif u"indent4" in clazz:
-        ind = 5
-    elif u"indent3" in clazz:
-        ind = 4
-    elif u"indent2" in clazz:
-        ind = 3
-    elif u"indent1" in clazz:
-        ind = 2
-    elif u"indent0" in clazz:
-        ind = 1
-    if ind > 0:
+    if _md_indent_re.search(clazz):
         return NBSP * 4
     return u''
 
-
-def process_zip(input_zip, wd):
-    wdir = wd + '/unzipped'
-    if os.path.exists(wdir):
-        shutil.rmtree(wdir)
-    os.makedirs(wdir)
-    hasher = hashlib.sha512()
+# Only a few distinct class attributes occur, so what is needed from each is
+# worked out once: its indentation, and its first and last space-separated
+# tokens, which are the ones has_class matches.
+_class_cache = {}
+def class_info(clazz):
+    info = _class_cache.get(clazz)
+    if info is None:
+        tokens = clazz.split(u' ')
+        info = (md_indent(clazz), tokens[0], tokens[-1])
+        _class_cache[clazz] = info
+    return info
+
+
+# Wall and CPU seconds spent in each stage of processing a title. Time is
+# charged to the innermost stage entered, so a stage that runs inside another
+# one (writing a file while rendering, say) is not counted twice.
+class stage_timer:
+    def __init__(self, stage):
+        self.wall = {}
+        self.cpu = {}
+        self.stack = [stage]
+        self.mark = (time.time(), time.clock())
+
+    def charge(self):
+        now = (time.time(), time.clock())
+        stage = self.stack[-1]
+        self.wall[stage] = self.wall.get(stage, 0.0) + now[0] - self.mark[0]
+        self.cpu[stage] = self.cpu.get(stage, 0.0) + now[1] - self.mark[1]
+        self.mark = now
+
+    def enter(self, stage):
+        self.charge()
+        self.stack.append(stage)
+
+    def leave(self):
+        self.charge()
+        self.stack.pop()
+
+    def report(self):
+        self.charge()
+        r = {}
+        for stage in self.wall:
+            r[stage] = {u'wall': self.wall[stage], u'cpu': self.cpu[stage]}
+        return r
+
+# On Linux the peak is read from /proc, where reset_peak_rss can start it over,
+# so that a worker measures each title on its own rather than the largest one
+# it has processed so far.
+def peak_rss_kb():
+    try:
+        f = open('/proc/self/status', 'r')
+        try:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+        finally:
+            f.close()
+    except IOError:
+        pass
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        # bytes, not kilobytes
+        rss = rss / 1024
+    return rss
+
+def reset_peak_rss():
+    try:
+        f = open('/proc/self/clear_refs', 'w')
+        try:
+            f.write('5')
+        finally:
+            f.close()
+    except IOError:
+        pass
+
+# Hashes everything read through it, so a digest can be taken while the bytes
+# are being consumed by something else (the parser, a copy) in fixed size chunks.
+# Reading (and inflating) and hashing count as the hash stage of timer.
+class hashing_reader:
+    def __init__(self, f, timer=None):
+        self.f = f
+        self.hasher = hashlib.sha512()
+        self.timer = timer or stage_timer(u'other')
+
+    def read(self, size=-1):
+        if size < 0:
+            size = HASH_CHUNK_SIZE
+        self.timer.enter(u'hash')
+        data = self.f.read(size)
+        self.hasher.update(data)
+        self.timer.leave()
+        return data
+
+    def hexdigest(self):
+        # Consumers such as the parser can stop before the end of the input.
+        while self.read(HASH_CHUNK_SIZE):
+            pass
+        return self.hasher.hexdigest()
+
+    def close(self):
+        self.f.close()
+
+# Titles whose XML is known to be broken at some release points. A fixup
+# applies to the titles listed at the release points rp1-rp2 for each rp2
+# listed. lines maps whole lines of the XML, without their line endings, to
+# what replaces them, see fixup_reader; a fixup without lines is for a title
+# that cannot be processed at all. issue goes in the README of the title when
+# the fixup changes something (or is printed if the title cannot be processed).
+InputFixup = namedtuple("InputFixup", "rp1 rp2 titles lines issue")
+INPUT_FIXUPS = [
+    InputFixup(rp1 = u"113", rp2 = [u"46"], titles = [u"16"], lines = None,
+            issue = u"usc16.xml at release 113-46 is a corrupt file"),
+    InputFixup(rp1 = u"113", rp2 = [u"65"], titles = [u"31"], lines = None,
+            issue = u"usc31.xml at release 113-65 is a corrupt file"),
+    # thru 114-115, this appendix is borked, missing a </appendix> before a </uscDoc>
+    InputFixup(rp1 = u"114", rp2 = [u"93not92", u"100not94not95", u"114not95not113", u"115not95"], titles = [u"50A"],
+            lines = {b"</uscDoc>": b"</appendix></uscDoc>"},
+            issue = u"* The XML file is missing a closing \\</appendix\\> before a closing \\</uscDoc\\>; we have inserted the former to process this file.\n"),
+]
+
+def input_fixups(rp1, rp2, title):
+    return [fx for fx in INPUT_FIXUPS if fx.rp1 == rp1 and rp2 in fx.rp2 and title in fx.titles]
+
+# Fails on a title that cannot be processed at all, otherwise returns the
+# fixups that repair it.
+def input_repairs(rp1, rp2, title):
+    fixups = input_fixups(rp1, rp2, title)
+    for fx in fixups:
+        if fx.lines is None:
+            print u"(FATAL) #### " + fx.issue
+            assert(False)
+            sys.exit(2)
+    return fixups
+
+# Applies the lines of fixups to the XML as it is read, in chunks, between the
+# reader and the parser. Only chunks holding one of the lines are split into
+# lines; a line is held back until its ending has been read. applied lists
+# the fixups that changed something.
+_line_end_re = re.compile(b'(\r\n|\r|\n)')
+class fixup_reader:
+    def __init__(self, f, fixups):
+        self.f = f
+        self.lines = {}
+        for fx in fixups:
+            for line in fx.lines:
+                self.lines[line] = (fx.lines[line], fx)
+        self.applied = []
+        self.carry = b''
+        self.buf = b''
+        self.pos = 0
+        self.eof = False
+
+    def read(self, size=-1):
+        if size < 0:
+            size = HASH_CHUNK_SIZE
+        while len(self.buf) - self.pos < size and not self.eof:
+            data = self.f.read(HASH_CHUNK_SIZE)
+            if data:
+                data = self.carry + data
+                cut = data.rfind(b'\n') + 1
+                self.carry = data[cut:]
+                data = data[:cut]
+            else:
+                self.eof = True
+                data = self.carry
+                self.carry = b''
+            self.buf = self.buf[self.pos:] + self.fix(data)
+            self.pos = 0
+        data = self.buf[self.pos:self.pos + size]
+        self.pos = self.pos + len(data)
+        return data
+
+    def fix(self, data):
+        for line in self.lines:
+            if line in data:
+                break
+        else:
+            return data
+        parts = _line_end_re.split(data)
+        for i in xrange(0, len(parts), 2):
+            if parts[i] in self.lines:
+                repl, fx = self.lines[parts[i]]
+                parts[i] = repl
+                if not (fx in self.applied):
+                    self.applied.append(fx)
+        return b''.join(parts)
+
+    def close(self):
+        self.f.close()
+
+def process_zip(input_zip, wd, digest=True):
+    # Titles are read straight out of the ZIP by each worker (see open_title_xml),
+    # so nothing is extracted here; we only hash it and find where the titles are.
+    sha = None
     try:
-        hasher.update(input_zip.read())
-        input_zip.seek(0)
         zip = zipfile.ZipFile(input_zip, 'r')
-        zip.extractall(wdir)
+        titledir = u""
+        for name in zip.namelist():
+            if name.startswith("xml/"):
+                titledir = u"xml/"
+                break
+        zip.close()
+        if digest:
+            input_zip.seek(0)
+            sha = hashing_reader(input_zip).hexdigest()
     finally:
         input_zip.close()
-    sha = hasher.hexdigest()
-    return ZipContents(sha512 = sha, titledir = wdir)
+    return ZipContents(sha512 = sha, zippath = os.path.abspath(input_zip.name), titledir = titledir)
+
+def open_title_xml(zip_contents, titlefilename):
+    # Every call gets its own handle on the ZIP, so pool workers never share one.
+    # The member stays readable after the ZipFile itself is closed.
+    zip = zipfile.ZipFile(zip_contents.zippath, 'r')
+    try:
+        return zip.open(zip_contents.titledir + titlefilename)
+    finally:
+        zip.close()
 
+# Previous output is reused or updated in place, see title_writer; unless
+# it is kept, prune_output removes the titles that were not generated again.
 def prep_output(wd):
     wdir = wd + '/gen'
-    if os.path.exists(wdir):
-        shutil.rmtree(wdir)
-    os.makedirs(wdir)
+    if not os.path.exists(wdir):
+        os.makedirs(wdir)
 
-_quotes = {'"': "&quot;", "'": "&apos;"}
+def prune_output(wd, results):
+    tdir = wd + u'/gen/titles'
+    if not os.path.isdir(tdir):
+        return
+    done = set([u'usc' + r[u'title'] for r in results if r[u'status'] in [u'rendered', u'unchanged']])
+    for name in os.listdir(tdir):
+        if not (name in done):
+            print "Removing stale output " + tdir + u'/' + name
+            shutil.rmtree(tdir + u'/' + name)
+
+# Same as xml.sax.saxutils.escape with quotes, & first.
+_html_escape_re = re.compile(u'[&<>"\']')
+_html_escapes = [(u"&", u"&amp;"), (u">", u"&gt;"), (u"<", u"&lt;"), (u'"', u"&quot;"), (u"'", u"&apos;")]
 def html_escape(t):
-    return escape(t, _quotes)
+    if _html_escape_re.search(t) is None:
+        return t
+    for c, e in _html_escapes:
+        if c in t:
+            t = t.replace(c, e)
+    return t
 
 def has_class(elem, clazz):
     g = elem.get("class")
     if not g:
         return False
-    if g == clazz:
-        return True
-    return g.endswith(u" " + clazz) or g.startswith(clazz + u" ")
+    info = class_info(g)
+    return clazz == info[1] or clazz == info[2]
 
 def process_element(elem, inhtml, nofmt):
-    meta = u''
-    tag = elem.tag
-    text = elem.text
-    attrib = elem.attrib
-    tail = elem.tail
-    # Rule: Any text content must be MD-escaped
     outputs = []
-    links = []
-    footnotes = []
-    filesep = None
-    cid = None
-    content_pre = u''
-    content_post = u''
-    line_content_pre = u''
-    line_content_post = u''
-    chnofmt = False
-    extraproc = False
-    escaper = md_escape
-    if inhtml:
-        escaper = html_escape
-
-    # Example of a footnote in context:
-    # title 15,<ref class="footnoteRef" idref="fn002021">1</ref><note type="footnote" id="fn002021"><num>1</num> See References in Text note below.</note> the ter
-    if tag == TAG_REF and has_class(elem, u"footnoteRef"):
-        outputs.append(u' <sup>' + escaper(u'['))
-    elif tag == TAG_REF and elem.get(u'href'):
+    meta = []
+    md_renderer(outputs.append, meta).element(elem, inhtml, nofmt)
+    return ProcessedElement(inputmeta = u''.join(meta), outputmd = outputs, tail = elem.tail)
+
+# An element that md_renderer has opened and not yet closed.
+class render_frame:
+    def __init__(self, elem, inhtml):
+        self.elem = elem
+        self.kind = RENDER_KINDS.get(elem.tag, RENDER_PLAIN)
+        self.inhtml = inhtml
+        self.escaper = md_escape
         if inhtml:
-            hh = unicode(elem.get(u'href'))
-            rurl = u'https://publicdocs.github.io/go/links?ns=uslm&' + urllib.urlencode({u'ref' : hh.encode('utf-8')})
-            hesc1 = html_escape(rurl)
-            hesc2 = html_escape(hh)
-            outputs.append(u'<a href="' + hesc1 + '" data-uslm-ref="' + hesc2 + '">')
+            self.escaper = html_escape
+        self.chnofmt = False
+        # Text (and child tail) wrapping, applied to each fragment of the children
+        self.content_pre = u''
+        self.content_post = u''
+        # Prepended to every fragment that starts a line
+        self.prefix = u''
+        self.lastnl = True
+        # Tables drop the file delimiters of their cells
+        self.dropfd = False
+        # Only frames that change the fragments passing through them are put on
+        # the renderer's stack.
+        self.active = False
+
+# Renders an element tree in a single walk. Every fragment goes to sink as soon
+# as it is produced, after each open element that wraps or indents its contents
+# has been applied to it, innermost first. This gives the same fragments the
+# old recursion did by copying and rewriting its children's output lists at
+# every level. Meta blobs are appended to meta.
+class md_renderer:
+    def __init__(self, sink, meta):
+        self.sink = sink
+        self.meta = meta
+        self.frames = []
+
+    def emit(self, o, owner=None):
+        # owner is the frame of the element o belongs to; it is not wrapped
+        # again by its own element.
+        if not o:
+            return
+        frames = self.frames
+        if isinstance(o, FileDelimiter):
+            for i in xrange(len(frames) - 1, -1, -1):
+                f = frames[i]
+                if f.dropfd:
+                    return
+                f.lastnl = True
+        elif not isinstance(o, Link):
+            for i in xrange(len(frames) - 1, -1, -1):
+                f = frames[i]
+                if f is not owner and (f.content_pre or f.content_post) and o.strip():
+                    o = f.content_pre + o + f.content_post
+                if f.prefix:
+                    lastnl = f.lastnl
+                    f.lastnl = o.endswith(u'\n')
+                    if lastnl and o.strip():
+                        o = f.prefix + o
+        self.sink(o)
+
+    def text(self, f, text):
+        # The text of f's element, or the tail of one of its children
+        if text.strip() and (f.content_pre or f.content_post):
+            self.emit(f.content_pre + f.escaper(unicode(text).strip()) + f.content_post, f)
         else:
-            outputs.append(u'[')
-
-    if tag == TAG_NOTE and u"footnote" == elem.get(u'type'):
-        outputs.append(u' <sup><sup> ')
-
-    if tag == TAG_META:
-        meta = unicode(ElementTree.tostring(elem))
-    #elif tag == TAG_REF:
-    #    ref = '#'
-    #    outputs.append(u'[' + u''.join(elem.itertext()) + '](' + ref + ')')
-    elif tag == TAG_LAYOUT:
-        outputs.append(u'\n\n<table>\n')
-        for rowe in elem:
+            self.emit(f.escaper(unicode(text)), f)
+
+    def open(self, elem, inhtml, nofmt):
+        f = render_frame(elem, inhtml)
+        kind = f.kind
+        outputs = []
+        # Example of a footnote in context:
+        # title 15,<ref class="footnoteRef" idref="fn002021">1</ref><note type="footnote" id="fn002021"><num>1</num> See References in Text note below.</note> the ter
+        if kind == RENDER_REF:
+            if has_class(elem, u"footnoteRef"):
+                outputs.append(u' <sup>' + f.escaper(u'['))
+            elif elem.get(u'href'):
+                if inhtml:
+                    hh = unicode(elem.get(u'href'))
+                    rurl = u'https://publicdocs.github.io/go/links?ns=uslm&' + urllib.urlencode({u'ref' : hh.encode('utf-8')})
+                    hesc1 = html_escape(rurl)
+                    hesc2 = html_escape(hh)
+                    outputs.append(u'<a href="' + hesc1 + '" data-uslm-ref="' + hesc2 + '">')
+                else:
+                    outputs.append(u'[')
+        elif kind == RENDER_NOTE:
+            if u"footnote" == elem.get(u'type'):
+                outputs.append(u' <sup><sup> ')
+
+        if kind == RENDER_META:
+            pass
+        elif kind == RENDER_LAYOUT or kind == RENDER_TABLE:
+            f.dropfd = True
+            f.active = True
+        else:
+            line_content_pre = u''
+            if kind == RENDER_DIVISION and elem.get('identifier'):
+                cid = elem.get('identifier')
+                filesep = unicode(cid)
+                f.chnofmt = True
+                # The delimiter goes before everything else of this element,
+                # and is not seen by its own frame.
+                if elem.tag in TAGS_SECTION_LIKE:
+                    self.emit(FileDelimiter(identifier=filesep, dir=None, uslmid=filesep))
+                else:
+                    self.emit(FileDelimiter(identifier=filesep, dir=filesep, uslmid=filesep))
+                outputs.append(u'\n\n' + md_header_prefix(cid))
+            elif kind == RENDER_DIVISION or kind == RENDER_BREAK:
+                outputs.append(u'\n\n')
+            elif kind == RENDER_SIGNATURE:
+                if not nofmt:
+                    f.content_pre = NBSP * 30
+                    f.content_post = u''
+            elif kind == RENDER_BOLDEN:
+                if not nofmt:
+                    f.content_pre = u' __'
+                    f.content_post = u'__ '
+            elif kind == RENDER_QUOTED:
+                if True or not nofmt:
+                    line_content_pre = u'\n> '
+            clazz = elem.get('class')
+            if clazz:
+                f.prefix = class_info(clazz)[0]
+            f.prefix = f.prefix + line_content_pre
+            f.active = f.prefix or f.content_pre or f.content_post
+
+        if f.active:
+            self.frames.append(f)
+        for o in outputs:
+            self.emit(o, f)
+        return f
+
+    def close(self, f):
+        elem = f.elem
+        kind = f.kind
+        if elem.tag == TAG_HEADING:
+            self.emit(u'\n', f)
+
+        if kind == RENDER_REF:
+            if has_class(elem, u"footnoteRef"):
+                self.emit(f.escaper(u']') + u'</sup> ', f)
+            elif elem.get(u'href'):
+                if f.inhtml:
+                    self.emit(u'</a>', f)
+                else:
+                    href = md_escape(elem.get(u'href'))
+                    self.emit(u'][' + href + u']', f)
+                    self.emit(Link(href=elem.get(u'href'), refcontent=href), f)
+        elif kind == RENDER_NOTE:
+            if u"footnote" == elem.get(u'type'):
+                self.emit(u' </sup></sup> ', f)
+
+        if f.active:
+            self.frames.pop()
+
+    def element(self, elem, inhtml, nofmt):
+        f = self.open(elem, inhtml, nofmt)
+        body = self.bodies.get(f.kind)
+        if body is None:
+            if elem.text:
+                self.text(f, elem.text)
+            for child in elem:
+                self.element(child, inhtml, f.chnofmt)
+                if child.tail:
+                    self.text(f, child.tail)
+        else:
+            body(self, f)
+        self.close(f)
+
+    def meta_body(self, f):
+        self.meta.append(unicode(_xml.tostring(f.elem)))
+
+    def layout_body(self, f):
+        self.emit(u'\n\n<table>\n', f)
+        for rowe in f.elem:
             if not (rowe.tag == TAG_HEADER or rowe.tag == TAG_TOC_ITEM):
                 print u"(FATAL) #### FAIL layout FOUND ROW " + rowe.tag
                 assert(False)
-                system.exit(3)
-                return None
-            if rowe.get(u'rowspan'):
-                outputs.append(u'  <tr rowspan="' + str(int(rowe.get(u'rowspan')))+ '">\n')
-            else:
-                outputs.append(u'  <tr>\n')
-            for cole in rowe:
-                if not (cole.tag == TAG_COLUMN):
-                    print u"(FATAL) #### FAIL layout FOUND COL " + cole.tag
-                    assert(False)
-                    system.exit(3)
-                    return None
-                if cole.get(u'colspan'):
-                    outputs.append(u'    <td colspan="' + str(int(cole.get(u'colspan')))+ '"> ')
-                else:
-                    outputs.append(u'    <td> ')
-                colouts = []
-                p = process_element(cole, True, chnofmt)
-                if p.outputmd:
-                    # Already escaped
-                    for txtp in p.outputmd:
-                        if not txtp:
-                            continue
-                        if isinstance(txtp, FileDelimiter):
-                            continue
-                        colouts.append(txtp)
-                outputs.extend(colouts)
-                outputs.append(u'  </td>\n')
-            outputs.append(u'\n  </tr>\n')
-        outputs.append(u'</table>\n')
-    elif tag == TAG_TABLE:
-        outputs.append(u'\n\n<table>\n')
-        for sect in elem:
+                sys.exit(3)
+            self.table_row(f, rowe, [TAG_COLUMN], u"layout")
+        self.emit(u'</table>\n', f)
+
+    def table_body(self, f):
+        self.emit(u'\n\n<table>\n', f)
+        for sect in f.elem:
             if sect.tag == TAG_COLGROUP:
                 continue
             elif sect.tag == TAG_THEAD or sect.tag == TAG_TBODY or sect.tag == TAG_TFOOT:
-                for rowe in sect:
-                    if not (rowe.tag == TAG_TR):
-                        print u"(FATAL) #### FAIL table FOUND ROW " + rowe.tag
-                        assert(False)
-                        system.exit(3)
-                        return None
-                    if rowe.get(u'rowspan'):
-                        outputs.append(u'  <tr rowspan="' + str(int(rowe.get(u'rowspan')))+ '">\n')
-                    else:
-                        outputs.append(u'  <tr>\n')
-                    for cole in rowe:
-                        if not (cole.tag == TAG_TD or cole.tag == TAG_TH):
-                            print u"(FATAL) #### FAIL table FOUND COL " + cole.tag
-                            assert(False)
-                            system.exit(3)
-                            return None
-                        if cole.get(u'colspan'):
-                            outputs.append(u'    <td colspan="' + str(int(cole.get(u'colspan')))+ '"> ')
-                        else:
-                            outputs.append(u'    <td> ')
-                        colouts = []
-                        p = process_element(cole, True, chnofmt)
-                        if p.outputmd:
-                            # Already escaped
-                            for txtp in p.outputmd:
-                                if not txtp:
-                                    continue
-                                if isinstance(txtp, FileDelimiter):
-                                    continue
-                                colouts.append(txtp)
-                        outputs.extend(colouts)
-                        outputs.append(u'  </td>\n')
-                    outputs.append(u'\n  </tr>\n')
+                rows = list(sect)
             else:
-                rowe = sect
+                rows = [sect]
+            for rowe in rows:
                 if not (rowe.tag == TAG_TR):
                     print u"(FATAL) #### FAIL table FOUND ROW " + rowe.tag
                     assert(False)
-                    system.exit(3)
-                    return None
-                if rowe.get(u'rowspan'):
-                    outputs.append(u'  <tr rowspan="' + str(int(rowe.get(u'rowspan')))+ '">\n')
-                else:
-                    outputs.append(u'  <tr>\n')
-                for cole in rowe:
-                    if not (cole.tag == TAG_TD or cole.tag == TAG_TH):
-                        print u"(FATAL) #### FAIL table FOUND COL " + cole.tag
-                        assert(False)
-                        system.exit(3)
-                        return None
-                    if cole.get(u'colspan'):
-                        outputs.append(u'    <td colspan="' + str(int(cole.get(u'colspan')))+ '"> ')
-                    else:
-                        outputs.append(u'    <td> ')
-                    colouts = []
-                    p = process_element(cole, True, chnofmt)
-                    if p.outputmd:
-                        # Already escaped
-                        for txtp in p.outputmd:
-                            if not txtp:
-                                continue
-                            if isinstance(txtp, FileDelimiter):
-                                continue
-                            colouts.append(txtp)
-                    outputs.extend(colouts)
-                    outputs.append(u'  </td>\n')
-                outputs.append(u'\n  </tr>\n')
-        outputs.append(u'</table>\n')
-    else:
-        extraproc = True
-        if elem.get('identifier') and (tag in TAGS_HEADINGS):
-            cid = elem.get('identifier')
-            filesep = unicode(cid)
-            chnofmt = True
-            outputs.append(u'\n\n' + md_header_prefix(cid))
-        elif tag in TAGS_BREAK:
-            outputs.append(u'\n\n')
-        elif tag == TAG_SIGNATURE:
-            if not nofmt:
-                content_pre = NBSP * 30
-                content_post = u''
-        elif tag in TAGS_BOLDEN:
-            if not nofmt:
-                content_pre = u' __'
-                content_post = u'__ '
-        elif tag in TAGS_QUOTED:
-            if True or not nofmt:
-                line_content_pre = u'\n> '
-                line_content_post = u' '
-
-        if text:
-            if text.strip() and (content_pre or content_post):
-                outputs.append(content_pre + escaper(unicode(text).strip()) + content_post)
-            else:
-                outputs.append(escaper(unicode(text)))
+                    sys.exit(3)
+                self.table_row(f, rowe, [TAG_TD, TAG_TH], u"table")
+        self.emit(u'</table>\n', f)
 
-        for child in elem:
-            p = process_element(child, inhtml, chnofmt)
-            if p.outputmd:
-                # Already escaped
-                for txtp in p.outputmd:
-                    if not txtp:
-                        continue
-                    if isinstance(txtp, FileDelimiter) or isinstance(txtp, Link):
-                        outputs.append(txtp)
-                        continue
-                    if txtp.strip() and (content_pre or content_post):
-                        outputs.append(content_pre + txtp + content_post)
-                    else:
-                        outputs.append(txtp)
-            if p.inputmeta:
-                meta = meta + p.inputmeta
-            if p.tail:
-                if p.tail.strip() and (content_pre or content_post):
-                    outputs.append(content_pre + escaper(unicode(p.tail).strip()) + content_post)
-                else:
-                    outputs.append(escaper(unicode(p.tail)))
+    # Elements whose contents are not just their text and children
+    bodies = {RENDER_META: meta_body, RENDER_LAYOUT: layout_body, RENDER_TABLE: table_body}
 
-    if tag == TAG_HEADING:
-        outputs.append(u'\n')
-
-    if tag == TAG_REF and has_class(elem, u"footnoteRef"):
-        outputs.append(escaper(u']') + u'</sup> ')
-    elif tag == TAG_REF and elem.get(u'href'):
-        if inhtml:
-            outputs.append(u'</a>')
+    def table_row(self, f, rowe, coltags, kind):
+        if rowe.get(u'rowspan'):
+            self.emit(u'  <tr rowspan="' + str(int(rowe.get(u'rowspan')))+ '">\n', f)
         else:
-            href = md_escape(elem.get(u'href'))
-            outputs.append(u'][' + href + u']')
-            outputs.append(Link(href=elem.get(u'href'), refcontent=href))
-
-    if tag == TAG_NOTE and u"footnote" == elem.get(u'type'):
-        outputs.append(u' </sup></sup> ')
-
-    ind = u""
-    if extraproc and elem.get('class'):
-        ind = md_indent(elem.get('class'))
-
-    outputs2 = []
-    lastnl = True
+            self.emit(u'  <tr>\n', f)
+        for cole in rowe:
+            if not (cole.tag in coltags):
+                print u"(FATAL) #### FAIL " + kind + u" FOUND COL " + cole.tag
+                assert(False)
+                sys.exit(3)
+            if cole.get(u'colspan'):
+                self.emit(u'    <td colspan="' + str(int(cole.get(u'colspan')))+ '"> ', f)
+            else:
+                self.emit(u'    <td> ', f)
+            # Only the cell's markdown is kept, not its meta or tail.
+            meta = self.meta
+            self.meta = []
+            self.element(cole, True, f.chnofmt)
+            self.meta = meta
+            self.emit(u'  </td>\n', f)
+        self.emit(u'\n  </tr>\n', f)
+
+# An element from TAGS_STREAM_CONTAINER that is still open during streaming.
+class stream_frame:
+    def __init__(self, rf):
+        self.rf = rf
+        self.textdone = False
+        self.pending = None
+
+def stream_flush_child(r, f):
+    # Called once everything before the next child (or the end) of the
+    # innermost frame has been parsed: its text, or the previous child's tail.
+    if not f.textdone:
+        f.textdone = True
+        if f.rf.elem.text:
+            r.text(f.rf, f.rf.elem.text)
+    if f.pending is not None:
+        if f.pending.tail:
+            r.text(f.rf, f.pending.tail)
+        f.rf.elem.remove(f.pending)
+        f.pending = None
+
+def stream_title(source, meta, render=None, counts=None):
+    # Yields the same outputs as process_element(root).outputmd, but each child
+    # of a TAGS_STREAM_CONTAINER element is rendered as soon as its end tag is
+    # parsed and then dropped from the tree.
+    # render is called with the element and nofmt. Elements parsed are
+    # counted by tag in counts, if given.
+    if render is None:
+        render = lambda elem, nofmt: process_element(elem, False, nofmt)
+    outs = []
+    r = md_renderer(outs.append, meta)
+    stack = []
+    chunkdepth = 0
+    for event, elem in _xml.iterparse(source, ('start', 'end')):
+        if counts is not None and event == 'start':
+            counts[elem.tag] = counts.get(elem.tag, 0) + 1
+        if chunkdepth:
+            if event == 'start':
+                chunkdepth = chunkdepth + 1
+                continue
+            chunkdepth = chunkdepth - 1
+            if chunkdepth:
+                continue
+            f = stack[-1]
+            p = render(elem, f.rf.chnofmt)
+            meta.append(p.inputmeta)
+            for o in p.outputmd:
+                r.emit(o)
+            del elem[:]
+            elem.text = None
+            f.pending = elem
+        elif event == 'start':
+            if stack:
+                stream_flush_child(r, stack[-1])
+            if stack and not (elem.tag in TAGS_STREAM_CONTAINER):
+                chunkdepth = 1
+            else:
+                nofmt = False
+                if stack:
+                    nofmt = stack[-1].rf.chnofmt
+                stack.append(stream_frame(r.open(elem, False, nofmt)))
+        else:
+            f = stack.pop()
+            stream_flush_child(r, f)
+            r.close(f.rf)
+            if stack:
+                stack[-1].pending = elem
+            else:
+                elem.clear()
+        for o in outs:
+            yield o
+        del outs[:]
+
+# Rendered outputs are stored with marshal, so FileDelimiter and Link are
+# flattened into tagged tuples.
+def fragments_dump(outputs):
+    l = []
     for o in outputs:
         if isinstance(o, FileDelimiter):
-            lastnl = True
-            outputs2.append(o)
+            l.append((0, ) + tuple(o))
         elif isinstance(o, Link):
-            outputs2.append(o)
+            l.append((1, ) + tuple(o))
         else:
-            if extraproc and o.strip() and lastnl:
-                outputs2.append(ind + line_content_pre + o)
+            l.append(o)
+    return marshal.dumps(l)
+
+def fragments_load(data):
+    l = []
+    for o in marshal.loads(data):
+        if isinstance(o, tuple):
+            if o[0] == 0:
+                o = FileDelimiter(*o[1:])
             else:
-                outputs2.append(o)
-            lastnl = o.endswith(u'\n')
-
-    if filesep:
-        if tag in TAGS_SECTION_LIKE:
-            outputs2.insert(0, FileDelimiter(identifier=filesep, dir=None, uslmid=filesep))
-        else:
-            outputs2.insert(0, FileDelimiter(identifier=filesep, dir=filesep, uslmid=filesep))
-
-    retp = ProcessedElement(inputmeta = meta, outputmd = outputs2, tail = elem.tail)
-    return retp
-
-def delete_line(path1, path2, num):
-    fr = codecs.open(path1, 'rb', encoding='utf-8')
-    fw = codecs.open(path2, 'wb', encoding='utf-8')
-    i = 1
-    for line in fr:
-        if i == num:
-            fw.write(u'\n')
+                o = Link(*o[1:])
+        l.append(o)
+    return l
+
+# Caches the rendering of each child of the stream frames (sections, mostly),
+# keyed by a digest of the child's XML. Lookups go to the database written by
+# the previous run, and the entries used in this run are written to a new one
+# that replaces it at the end, so stale sections do not accumulate.
+class section_cache:
+    def __init__(self, path):
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self.old = None
+        if os.path.exists(path):
+            self.old = sqlite3.connect(path)
+            row = self.old.execute('SELECT value FROM info WHERE name = ?', (u'version', )).fetchone()
+            if not row or row[0] != software_version():
+                self.old.close()
+                self.old = None
+        if os.path.exists(path + u'.new'):
+            os.remove(path + u'.new')
+        self.new = sqlite3.connect(path + u'.new')
+        self.new.execute('CREATE TABLE info (name TEXT PRIMARY KEY, value TEXT)')
+        self.new.execute('CREATE TABLE sections (key TEXT PRIMARY KEY, meta TEXT, body BLOB)')
+        self.new.execute('INSERT INTO info VALUES (?, ?)', (u'version', software_version()))
+
+    def render(self, elem, nofmt):
+        # The tail is not part of the element's own rendering, and may or may
+        # not have been parsed yet.
+        tail = elem.tail
+        elem.tail = None
+        key = unicode(hashlib.sha1(_xml.tostring(elem)).hexdigest())
+        elem.tail = tail
+        if nofmt:
+            key = key + u'n'
+        row = None
+        if self.old:
+            row = self.old.execute('SELECT meta, body FROM sections WHERE key = ?', (key, )).fetchone()
+        if row:
+            self.hits = self.hits + 1
+            body = str(row[1])
+            p = ProcessedElement(inputmeta = row[0], outputmd = fragments_load(body), tail = elem.tail)
         else:
-            fw.write(line)
-        i = i + 1
-    fr.close()
-    fw.close()
-
-def replace_line(path1, path2, a1, a2):
-    fr = codecs.open(path1, 'rb', encoding='utf-8')
-    fw = codecs.open(path2, 'wb', encoding='utf-8')
-    i = 1
-    for line in fr:
-        if line == a1:
-            fw.write(a2)
-        else:
-            fw.write(line)
-        i = i + 1
-    fr.close()
-    fw.close()
+            self.misses = self.misses + 1
+            p = process_element(elem, False, nofmt)
+            body = fragments_dump(p.outputmd)
+        self.new.execute('INSERT OR IGNORE INTO sections VALUES (?, ?, ?)', (key, p.inputmeta, buffer(body)))
+        return p
+
+    def close(self):
+        self.new.commit()
+        self.new.close()
+        if self.old:
+            self.old.close()
+        os.rename(self.path + u'.new', self.path)
+
+# Wraps a render function for stream_title so that it is timed as the render
+# stage of timer.
+def timed_render(timer, render=None):
+    if render is None:
+        render = lambda elem, nofmt: process_element(elem, False, nofmt)
+    def timed(elem, nofmt):
+        timer.enter(u'render')
+        try:
+            return render(elem, nofmt)
+        finally:
+            timer.leave()
+    return timed
 
 def md_fancy(cid):
     return cid
@@ -628,163 +1064,524 @@ def file_safe_uslm_id(cid):
         return
     return cid
 
-def process_title(zip_contents, title, rp1, rp2, notice, wd):
-    rp1 = unicode(rp1)
-    rp2 = unicode(rp2)
-    notice = unicode(notice)
-    title = unicode(title)
-    wdir = wd + u'/gen/titles/usc' + title
-    issues = u''
-    if os.path.exists(wdir):
-        shutil.rmtree(wdir)
-    os.makedirs(wdir)
-    of = wdir + u'/title.md'
-    zipurl = _download_url_template.substitute(rp1 = rp1, rp2 = rp2)
-    titlefilename = u"usc" + title + u".xml"
-    moredir = "xml/"
-    if not (os.path.exists(zip_contents.titledir + u"/" + moredir) and os.path.isdir(zip_contents.titledir + u"/" + moredir)):
-        moredir = u""
-    titlepath = zip_contents.titledir + u"/" + moredir + titlefilename
-
+# Identifies this version of the software in the build manifest; any change to
+# this file invalidates all of the previously generated titles.
+_software_version = None
+def software_version():
+    global _software_version
+    if _software_version is None:
+        f = open(os.path.splitext(os.path.abspath(__file__))[0] + '.py', 'rb')
+        _software_version = unicode(hashlib.sha512(f.read()).hexdigest())
+        f.close()
+    return _software_version
 
-    hasher = hashlib.sha512()
+# The build manifest has one JSON file per title, so that every worker only
+# ever reads and writes its own title's entry.
+def read_manifest_entry(manifest_dir, title):
     try:
-        hasher.update(open(titlepath, 'rb').read())
-    except:
-        print u"(Non-Fatal) #### Skipping; Could not read title " + str(title)
-        return -1
-    xmlsha = hasher.hexdigest()
-
-    if rp1 == u"113" and rp2 == u"46" and title == u"16":
-        print u"(FATAL) #### usc16.xml at release 113-46 is a corrupt file"
-        assert(False)
-        sys.exit(2)
-        return
-    if rp1 == u"113" and rp2 == u"65" and title == u"31":
-        print u"(FATAL) #### usc31.xml at release 113-65 is a corrupt file"
-        assert(False)
-        sys.exit(2)
-        return
-    if rp1 == u"114":
-        if rp2 in [u"93not92", u"100not94not95", u"114not95not113", u"115not95"]:
-            if title == u"50A":
-                # thru 114-115, this appendix is borked, missing a </appendix> before a </uscDoc>
-                replace_line(titlepath, titlepath + u"_mod.xml", u"</uscDoc>\n", u"</appendix></uscDoc>\n")
-                titlepath = titlepath + u"_mod.xml"
-                replace_line(titlepath, titlepath + u"_mod.xml", u"</uscDoc>\r", u"</appendix></uscDoc>\r")
-                titlepath = titlepath + u"_mod.xml"
-                replace_line(titlepath, titlepath + u"_mod.xml", u"</uscDoc>", u"</appendix></uscDoc>")
-                titlepath = titlepath + u"_mod.xml"
-                iss1 = u"* The XML file is missing a closing \\</appendix\\> before a closing \\</uscDoc\\>; we have inserted the former to process this file.\n"
-                print u"(Non-Fatal) #### " +u"ISSUE WITH " + titlepath + u": " + iss1
-                issues = issues + iss1
-
-
+        f = open(manifest_dir + u'/usc' + title + u'.json', 'rb')
+        try:
+            return json.load(f)
+        finally:
+            f.close()
+    except (IOError, ValueError):
+        return None
+
+def write_manifest_entry(manifest_dir, title, entry, suffix=u'.json'):
     try:
-        origxml = ElementTree.parse(titlepath).getroot()
-    except:
-        print u"(FATAL) #### FAILURE TO PARSE " + titlepath
-        raise
-
-
-
-    p = process_element(origxml, False, False)
-    outsets = []
-    fd = None
-    lastdir = None
-    lastoutset = []
-    lastlinkset = []
-
-    titletrunc = title
-    while titletrunc.startswith(u'0'):
-        titletrunc = titletrunc[1:]
+        os.makedirs(manifest_dir)
+    except OSError:
+        if not os.path.isdir(manifest_dir):
+            raise
+    path = manifest_dir + u'/usc' + title + suffix
+    f = open(path + u'.tmp', 'wb')
+    json.dump(entry, f)
+    f.close()
+    os.rename(path + u'.tmp', path)
+
+# Every generated file is listed, with its digest, in usc<title>.files.json
+# next to the title's manifest entry. The digest is the file's git blob id, so
+# it can also be checked against a tree in the repository. The release point
+# metadata (the release point, URLs and SHA 512 digests of the inputs) only
+# ever appears in README.md, so the entry keeps the digest of the README apart
+# from content_digest, the digest of the list of all the other files.
+def file_digest(data):
+    return unicode(hashlib.sha1('blob ' + str(len(data)) + '\0' + data).hexdigest())
+
+def content_digest(digests):
+    h = hashlib.sha1()
+    for rel in sorted(digests):
+        h.update(digests[rel].encode('utf-8') + ' ' + rel.encode('utf-8') + '\n')
+    return unicode(h.hexdigest())
+
+def read_manifest_files(manifest_dir, title):
+    return read_manifest_entry(manifest_dir, title + u'.files') or {}
+
+# Classifies how a title changed from one manifest entry to the next, as
+# update-repo.sh does by diffing the generated trees: new (no previous entry),
+# unchanged, metadata (only the README differs) or content.
+def classify_title_change(old, new):
+    if not old or old.get(u'content_digest') is None or new.get(u'content_digest') is None:
+        return u'new'
+    if old[u'content_digest'] != new[u'content_digest']:
+        return u'content'
+    if old[u'readme_digest'] != new[u'readme_digest']:
+        return u'metadata'
+    return u'unchanged'
+
+# How many files were changed, added and removed from one manifest files map
+# (see read_manifest_files) to the next.
+def count_file_changes(oldfiles, newfiles):
+    changed = added = 0
+    for rel in newfiles:
+        if rel not in oldfiles:
+            added = added + 1
+        elif oldfiles[rel] != newfiles[rel]:
+            changed = changed + 1
+    removed = len([rel for rel in oldfiles if rel not in newfiles])
+    return [changed, added, removed]
+
+# Prints one line per title for the manifests in old_dir and new_dir: the
+# title, how it changed (see classify_title_change), and how many of its files
+# were changed, added and removed.
+def compare_manifests(old_dir, new_dir, titles):
+    at = titles
+    if not at:
+        at = ALL_TITLES
+    for title in at:
+        old = read_manifest_entry(old_dir, title)
+        new = read_manifest_entry(new_dir, title)
+        if not new:
+            continue
+        change = classify_title_change(old, new)
+        changed = added = removed = 0
+        if change == u'content':
+            changed, added, removed = count_file_changes(read_manifest_files(old_dir, title), read_manifest_files(new_dir, title))
+        print title + " " + change + " " + str(changed) + " " + str(added) + " " + str(removed)
+
+# Resident memory per byte of title XML, for titles processed for the first
+# time; the whole tree of a title parsed with cElementTree takes about 12 times
+# its size.
+RSS_KB_PER_XML_BYTE = 12.0 / 1024
+
+# Per title, the value from history if there is one, or else its XML size
+# scaled by the ratio of the titles that do have one (or by rate).
+def scale_by_size(titles, sizes, history, rate):
+    known = [t for t in history if sizes[t] > 0]
+    if known:
+        rate = float(sum([history[t] for t in known])) / sum([sizes[t] for t in known])
+    r = {}
+    for title in titles:
+        if title in history:
+            r[title] = history[title]
+        else:
+            r[title] = sizes[title] * rate
+    return r
+
+# Estimates how long each title will take, so that work can be ordered
+# longest-processing-time-first: the biggest titles start right away and the
+# small ones fill in around them. The cost of a title is how long it took last
+# time, or failing that, its XML size scaled by how fast the titles with a
+# history were processed. The memory it needs (in KB) is estimated the same
+# way, from its peak RSS last time. Returns the costs, the XML sizes and the
+# memory.
+def estimate_title_costs(zip_contents, titles, manifest_dir):
+    sizes = {}
+    zip = zipfile.ZipFile(zip_contents.zippath, 'r')
+    for title in titles:
+        try:
+            sizes[title] = zip.getinfo(zip_contents.titledir + u"usc" + title + u".xml").file_size
+        except KeyError:
+            sizes[title] = 0
+    zip.close()
+    seconds = {}
+    rss = {}
+    for title in titles:
+        entry = read_manifest_entry(manifest_dir, title)
+        if entry and entry.get(u'seconds') is not None:
+            seconds[title] = entry[u'seconds']
+        if entry and entry.get(u'peak_rss_kb') is not None:
+            rss[title] = entry[u'peak_rss_kb']
+    cost = scale_by_size(titles, sizes, seconds, 1.0)
+    memory = scale_by_size(titles, sizes, rss, RSS_KB_PER_XML_BYTE)
+    return cost, sizes, memory
+
+# A dict that holds at most size entries, dropping the least recently used.
+# Each entry is stamped with when it was last used; once there are too many,
+# the least recently used half is dropped at once, which keeps hits cheap
+# (OrderedDict is written in Python here).
+class lru_cache:
+    def __init__(self, size):
+        self.size = size
+        self.entries = {}
+        self.tick = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        e = self.entries.get(key)
+        if e is None:
+            self.misses = self.misses + 1
+            return None
+        self.hits = self.hits + 1
+        self.tick = self.tick + 1
+        e[1] = self.tick
+        return e[0]
+
+    def put(self, key, value):
+        self.tick = self.tick + 1
+        self.entries[key] = [value, self.tick]
+        if len(self.entries) > self.size:
+            keep = self.size // 2
+            for k, e in sorted(self.entries.items(), key=lambda i: i[1][1])[:len(self.entries) - keep]:
+                del self.entries[k]
+
+# The same few targets are referenced from thousands of files, and from every
+# title a worker processes, so their redirector URLs are remembered.
+_link_urls = lru_cache(LINK_CACHE_SIZE)
+def link_url(ref):
+    url = _link_urls.get(ref)
+    if url is None:
+        url = md_escape(u'https://publicdocs.github.io/go/links?ns=uslm&' + urllib.urlencode({u'ref' : unicode(ref).encode('utf-8')}))
+        _link_urls.put(ref, url)
+    return url
+
+# A page template compiled once, with the fields that are the same for every
+# page (such as the title) already filled in. The rest of the fields are filled
+# in by render(), which gives the same result as template.substitute() with
+# all of the fields.
+class page_skeleton:
+    def __init__(self, template, **constants):
+        parts = []
+        pos = 0
+        for m in template.pattern.finditer(template.template):
+            parts.append(template.template[pos:m.start()].replace(u'%', u'%%'))
+            pos = m.end()
+            name = m.group('named') or m.group('braced')
+            if m.group('escaped') is not None:
+                parts.append(template.delimiter)
+            elif name is None:
+                print u"(FATAL) #### Invalid placeholder in page template at " + unicode(m.start())
+                assert(False)
+                sys.exit(2)
+            elif name in constants:
+                parts.append(unicode(constants[name]).replace(u'%', u'%%'))
+            else:
+                parts.append(u'%(' + name + u')s')
+        parts.append(template.template[pos:].replace(u'%', u'%%'))
+        self.format = u''.join(parts)
 
-    inc = 0
-    allcids = set()
-    allfullcids = set()
-    osss = p.outputmd
-    hasFd = False
-    for o in osss:
-        if isinstance(o, FileDelimiter):
-            hasFd = True
-            if o.identifier in allcids:
-                print "(Non-Fatal) #### Duplicate USLM identifier " + o.identifier + " at " + titlepath
-            allcids.add(o.identifier)
-    if not hasFd:
-        cid2 = (u"/us/usc/t" + titletrunc).lower()
-        print u"(Non-Fatal) #### " + titlepath + u" is missing any file delimiters; adding an artificial one with id =" + cid2
-        osss.append(FileDelimiter(identifier=cid2, dir=cid2))
+    def render(self, **fields):
+        return self.format % fields
 
+_readme_skeleton = page_skeleton(_out_readme_markdown)
 
-    # dummy terminator
-    osss.append(FileDelimiter())
-    for o in osss:
+def write_title_readme(wdir, issues, **fields):
+    of = wdir + u'/README.md'
+    if issues:
+        issues = u'Issues: \n\n' + issues + '\n'
+    fc = _readme_skeleton.render(issues = issues, **fields).encode('utf8')
+    f = open(of, 'w')
+    f.write(fc)
+    f.close()
+    return fc
+
+# With --fast-import, each title also gets a fragment of git fast-import file
+# commands: the title's directory is deleted, then every file is added with
+# inline data. The main process turns the fragments into commits, see
+# fast_import_stream. With fast_import_base, the commits start from a tree that
+# already holds the previous output of the titles, so the fragment of a title
+# that --incremental found unchanged only has its README.md.
+def fast_import_quote(path):
+    if path.startswith(u'"') or u'\n' in path:
+        return u'"' + path.replace(u'\\', u'\\\\').replace(u'"', u'\\"').replace(u'\n', u'\\n') + u'"'
+    return path
+
+def fast_import_file(f, path, data):
+    f.write('M 100644 inline ' + fast_import_quote(path).encode('utf-8') + '\n')
+    f.write('data ' + str(len(data)) + '\n')
+    f.write(data)
+    f.write('\n')
+
+def fast_import_fragment_path(wd, title):
+    return wd + u'/fastimport/usc' + title + u'.fi'
+
+def open_fast_import_fragment(wd, title, prefix, delete=True):
+    path = fast_import_fragment_path(wd, title)
+    if not os.path.exists(os.path.dirname(path)):
+        try:
+            os.makedirs(os.path.dirname(path))
+        except OSError:
+            if not os.path.isdir(os.path.dirname(path)):
+                raise
+    f = open(path, 'wb')
+    if delete:
+        f.write('D ' + fast_import_quote(prefix + u'usc' + title).encode('utf-8') + '\n')
+    return f
+
+# Adds every file under wdir, for titles whose files were not just written.
+def fast_import_tree(f, prefix, title, wdir):
+    for dirpath, dirnames, filenames in os.walk(wdir):
+        dirnames.sort()
+        for fn in sorted(filenames):
+            of = os.path.join(dirpath, fn)
+            rel = os.path.relpath(of, wdir).replace(os.sep, u'/')
+            g = open(of, 'rb')
+            fast_import_file(f, prefix + u'usc' + title + u'/' + rel, g.read())
+            g.close()
+
+# The stream of commits given to git fast-import, written to a file and/or
+# straight into git fast-import for git_dir. The first commit starts from
+# parent (unless it is None); later ones follow on the same branch.
+class fast_import_stream:
+    def __init__(self, path, git_dir, branch, parent, committer):
+        self.branch = branch
+        self.parent = parent
+        self.committer = committer
+        self.outs = []
+        self.file = None
+        self.proc = None
+        if path:
+            self.file = open(path, 'wb')
+            self.outs.append(self.file)
+        if git_dir:
+            # git fast-import would only stop at the first commit, in the
+            # middle of the stream.
+            if parent and subprocess.call(['git', '--git-dir=' + git_dir, 'rev-parse', '--verify', '--quiet', parent + '^{commit}'], stdout=open(os.devnull, 'w')) != 0:
+                print u"(FATAL) #### " + parent + u" is not a commit in " + git_dir + u"; use --fast-import-from none to start a new history"
+                assert(False)
+                sys.exit(2)
+            self.proc = subprocess.Popen(['git', '--git-dir=' + git_dir, 'fast-import', '--quiet'], stdin=subprocess.PIPE)
+            self.outs.append(self.proc.stdin)
+        self.commits = 0
+
+    def write(self, data):
+        for o in self.outs:
+            try:
+                o.write(data)
+            except IOError:
+                if o is self.file:
+                    raise
+                print u"(FATAL) #### git fast-import stopped; see its error above"
+                assert(False)
+                sys.exit(2)
+
+    def commit(self, message, fragments):
+        msg = message.encode('utf-8')
+        self.write('commit refs/heads/' + self.branch.encode('utf-8') + '\n')
+        self.write('committer ' + self.committer.encode('utf-8') + ' ' + str(int(time.time())) + ' +0000\n')
+        self.write('data ' + str(len(msg)) + '\n' + msg + '\n')
+        if self.commits == 0 and self.parent:
+            self.write('from ' + self.parent.encode('utf-8') + '\n')
+        for fragment in fragments:
+            f = open(fragment, 'rb')
+            while True:
+                data = f.read(HASH_CHUNK_SIZE)
+                if not data:
+                    break
+                self.write(data)
+            f.close()
+        self.write('\n')
+        self.commits = self.commits + 1
+
+    def close(self):
+        if self.file:
+            self.file.close()
+        if self.proc:
+            self.proc.stdin.close()
+            if self.proc.wait() != 0:
+                print u"(FATAL) #### git fast-import failed"
+                assert(False)
+                sys.exit(2)
+
+# Splits the rendered outputs of a title at each FileDelimiter and writes one
+# file per delimiter. A file is written once the following delimiter is seen,
+# since that is when its "Next" link is known.
+class title_writer:
+    def __init__(self, wdir, titlepath, titletrunc, fancytitle, timer=None, queue=0):
+        # wdir may still hold the previous output of the title: files whose
+        # bytes are unchanged are left alone, so that their mtimes stay the
+        # same, and files that are no longer generated are removed by close().
+        # Splitting into files and writing them are timed as the split and
+        # write stages of timer.
+        self.timer = timer or stage_timer(u'other')
+        # With --fast-import, every file is also added to this fragment, under
+        # fragment_path.
+        self.fragment = None
+        self.fragment_path = None
+        # Both the label and the URL of a link definition come from its
+        # href, so with dedupe_links only the first of a file's definitions
+        # for each href is written.
+        self.dedupe_links = False
+        # With --xref-index, the xref_index links are looked up in, and the
+        # hrefs looked up.
+        self.xref = None
+        self.xref_hrefs = set()
+        # With --ir-cache, the title_ir_writer every file is also saved to.
+        self.ir = None
+        self.bytes_written = 0
+        # The digest of every file, by its path relative to wdir; see
+        # file_digest.
+        self.digests = {}
+        self.issues = []
+        # Paths relative to wdir of the files written, and the directories
+        # known to exist.
+        self.written = set()
+        self.dirs = set()
+        self.wdir = wdir
+        self.titlepath = titlepath
+        self.titletrunc = titletrunc
+        self.fancytitle = fancytitle
+        self.page = page_skeleton(_out_header_markdown, fancytitle = fancytitle)
+        self.fd = None
+        self.lastdir = None
+        self.lastoutset = []
+        self.lastlinkset = []
+        self.allcids = set()
+        self.allfullcids = set()
+        self.pending = None
+        self.index = u'\n\n'
+        self.count = 0
+        # With a queue size, files are written by a thread of their own, so
+        # that rendering goes on while they are written; up to that many
+        # files wait to be written before add() blocks. The write stage of
+        # timer is then only the time spent waiting for the thread.
+        self.queue = None
+        self.thread = None
+        self.error = None
+        if queue:
+            self.queue = Queue.Queue(queue)
+            self.thread = threading.Thread(target=self.write_queued)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def add(self, o):
         if isinstance(o, FileDelimiter):
-            if fd:
-                cid = file_safe_uslm_id(fd.identifier)
+            self.timer.enter(u'split')
+            if o.identifier in self.allcids:
+                self.issue(u"Duplicate USLM identifier " + o.identifier + u" at " + self.titlepath)
+            self.allcids.add(o.identifier)
+            self.delimit(o)
+            self.timer.leave()
+        elif isinstance(o, Link):
+            self.lastlinkset.append(o)
+        else:
+            self.lastoutset.append(o)
+
+    def delimit(self, o):
+        fd = self.fd
+        if fd:
+            lastdir = self.lastdir
+            cid = file_safe_uslm_id(fd.identifier)
+            fn = (u'/m_') + cid + u'.md'
+            tr = u'./' + (u'../' * lastdir.count(u'/'))
+            while (lastdir + u'/' + fn) in self.allfullcids:
+                self.issue(u"Duplicate USLM identifier-file " + lastdir + u'/' + fn + u" at " + self.titlepath)
+                cid = file_safe_uslm_id(cid + u'^extra')
                 fn = (u'/m_') + cid + u'.md'
-                tr = u'./' + (u'../' * lastdir.count(u'/'))
-                while (lastdir + u'/' + fn) in allfullcids:
-                    print "(Non-Fatal) #### Duplicate USLM identifier-file " + lastdir + u'/' + fn + " at " + titlepath
-                    cid = file_safe_uslm_id(cid + u'^extra')
-                    fn = (u'/m_') + cid + u'.md'
-                allfullcids.add(lastdir + u'/' + fn)
-                outsets.append([fd._replace(titleroot = tr, dir=lastdir, filename = fn), lastoutset, lastlinkset])
-                lastoutset = []
-                lastlinkset = []
-                inc = inc + 1
-            fd = o
-            if o.dir:
-                lastdir = dir_safe_uslm_id(o.dir)
+            self.allfullcids.add(lastdir + u'/' + fn)
+            self.push([fd._replace(titleroot = tr, dir=lastdir, filename = fn), self.lastoutset, self.lastlinkset])
+            self.lastoutset = []
+            self.lastlinkset = []
+        self.fd = o
+        if o.dir:
+            self.lastdir = dir_safe_uslm_id(o.dir)
+
+    def issue(self, msg):
+        print u"(Non-Fatal) #### " + msg
+        self.issues.append(msg)
+
+    def push(self, outs):
+        lp = self.pending
+        if lp:
+            ln = outs[0]
+            lp[0] = lp[0]._replace(next = lp[0].titleroot + ln.dir + ln.filename)
+            self.write(lp)
+            outs[0] = ln._replace(prev = ln.titleroot + lp[0].dir + lp[0].filename)
+        self.pending = outs
+
+    def close(self):
+        self.timer.enter(u'split')
+        if not self.allcids:
+            cid2 = (u"/us/usc/t" + self.titletrunc).lower()
+            self.issue(self.titlepath + u" is missing any file delimiters; adding an artificial one with id =" + cid2)
+            self.delimit(FileDelimiter(identifier=cid2, dir=cid2))
+        # dummy terminator
+        self.delimit(FileDelimiter())
+        self.finish()
+        self.timer.leave()
+
+    # Writes the last file and removes the files not written. Files replayed
+    # from a title_ir go straight to write() and then here.
+    def finish(self):
+        if self.pending:
+            self.write(self.pending)
+            self.pending = None
+        if self.thread:
+            self.timer.enter(u'write')
+            self.stop()
+            self.timer.leave()
+            self.check_queued()
+        self.prune()
+
+    # Lets the writer thread write what is queued and waits for it to end, so
+    # that it does not outlive a title whose rendering failed.
+    def stop(self):
+        if self.thread:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+
+    def prune(self):
+        for dirpath, dirnames, filenames in os.walk(self.wdir, topdown=False):
+            for fn in filenames:
+                of = os.path.join(dirpath, fn)
+                rel = os.path.relpath(of, self.wdir).replace(os.sep, u'/')
+                if not (rel in self.written) and rel != u'README.md':
+                    os.remove(of)
+            if dirpath != self.wdir and not os.listdir(dirpath):
+                os.rmdir(dirpath)
+
+    def write(self, outs):
+        self.timer.enter(u'write')
+        if self.queue:
+            self.check_queued()
+            self.queue.put(outs)
         else:
-            if isinstance(o, Link):
-                lastlinkset.append(o)
-            else:
-                lastoutset.append(o)
-
-    outsets2 = []
-    ll = len(outsets)
-    for idx, o in enumerate(outsets):
-        fd = o[0]
-        lo = o[1]
-        linkset = o[2]
-        lprev = None
-        lnext = None
-        if idx > 0:
-            lp = outsets[idx - 1][0]
-            lprev = fd.titleroot + lp.dir + lp.filename
-        if idx < ll - 1:
-            ln = outsets[idx + 1][0]
-            lnext = fd.titleroot + ln.dir + ln.filename
-        outsets2.append([fd._replace(prev = lprev, next = lnext), lo, linkset])
-
-    finaloutsets = outsets2
-
-    print "Starting " + str(inc) + " entries for title " + str(title)
-
-    index = u'\n\n'
-
-    isappendix = title.endswith(u'A') or title.endswith(u'a')
-
-    fancytitle = titletrunc + u' U.S.C.'
-    if isappendix:
-        fancytitle = u"Appendix to " + titletrunc[:-1] + u' U.S.C.'
-
-    for outs in finaloutsets:
+            self.write_file(outs)
+        self.timer.leave()
+
+    def write_queued(self):
+        while True:
+            outs = self.queue.get()
+            if outs is None:
+                return
+            if self.error:
+                continue
+            try:
+                self.write_file(outs)
+            except:
+                self.error = sys.exc_info()
+
+    def check_queued(self):
+        if self.error:
+            print u"(FATAL) #### Failed to write the output of " + self.titlepath
+            raise self.error[0], self.error[1], self.error[2]
+
+    def write_file(self, outs):
+        if self.ir:
+            self.ir.dump(outs)
         linksetmd = u''
         linkset = outs[2]
         fd = outs[0]
         cid = outs[0].identifier
-        cdir = wdir + u'/' + outs[0].dir
-        if not os.path.exists(cdir):
-            os.makedirs(cdir)
+        cdir = self.wdir + u'/' + outs[0].dir
+        if not (cdir in self.dirs):
+            if not os.path.isdir(cdir):
+                os.makedirs(cdir)
+            self.dirs.add(cdir)
+        # delimit() has already made the path unique, see allfullcids.
         of = cdir + u'/' + outs[0].filename
-        if os.path.exists(of):
-            print "(FATAL) #### Cannot have the same identifier multiple times in one directory."
-            print "        #### Duplicate USLM identifier " + of + " at " + titlepath
-            assert(False)
-            sys.exit(2)
-            return
 
         filename_for_readme_index = u'./' + outs[0].dir + u'/' + outs[0].filename
 
@@ -795,19 +1592,29 @@ def process_title(zip_contents, title, rp1, rp2, notice, wd):
         idn = fd.dir.count(u'/') - 3
         if not (fd.dir == cid):
             idn = idn + 1
-        index = index + (u'  ' * (idn)) +  u'* [' + cid+ u']('+ filename_for_readme_index  +u')\n'
+        self.index = self.index + (u'  ' * (idn)) +  u'* [' + cid+ u']('+ filename_for_readme_index  +u')\n'
         linkhtml = u''
         if fd.prev:
             linkhtml = linkhtml + u'[Previous](' + fd.prev + u') | '
         else:
             linkhtml = linkhtml + u'~~Previous~~ | '
 
+        seen = set()
         for l in linkset:
+            if self.dedupe_links:
+                if l.href in seen:
+                    continue
+                seen.add(l.href)
+            url = None
+            if self.xref:
+                self.xref_hrefs.add(l.href)
+                target = self.xref.lookup(l.href)
+                if target:
+                    url = fd.titleroot + u'../usc' + target[0] + u'/' + target[1]
+            if url is None:
+                url = link_url(l.href)
             # refcontent md-escaped on construction
-            hh = unicode(l.href)
-            rps = u''
-            rurl = md_escape(u'https://publicdocs.github.io/go/links?ns=uslm&' + rps + urllib.urlencode({u'ref' : hh.encode('utf-8')}))
-            linksetmd = linksetmd + u'[' + l.refcontent + u']: ' + rurl + u'\n'
+            linksetmd = linksetmd + u'[' + l.refcontent + u']: ' + url + u'\n'
 
         if fd.next:
             linkhtml = linkhtml + u'[Next](' + fd.next + u') | '
@@ -819,36 +1626,879 @@ def process_title(zip_contents, title, rp1, rp2, notice, wd):
         else:
             linkhtml = linkhtml + u'~~Root of Title~~ | '
 
-        rurl = md_escape(u'https://publicdocs.github.io/go/links?ns=uslm&' + urllib.urlencode({u'ref' : unicode(outs[0].uslmid).encode('utf-8')}))
-        linkhtml = linkhtml + u'[Other Versions of this Document](' + rurl + u')'
+        linkhtml = linkhtml + u'[Other Versions of this Document](' + link_url(outs[0].uslmid) + u')'
 
-        fc = _out_header_markdown.substitute(
-                rp1 = rp1,
-                rp2 = rp2,
-                url = zipurl,
-                sha512zip = zip_contents.sha512,
-                titlefile = titlefilename,
+        fc = self.page.render(
                 docmd = u'./' + fd.titleroot + u'/README.md',
-                sha512xml = xmlsha,
                 filepart = md_escape(unicode(outs[0].uslmid)),
-                notice = notice,
-                origmd = p.inputmeta,
-                title = title,
                 navlinks = linkhtml,
                 linkset = linksetmd,
                 innercontent = cont,
-                titletrunc = titletrunc,
-                filepartfancy = md_fancy(cid),
-                fancytitle = fancytitle,
         )
-        f = open(of, 'w')
-        f.write(fc.encode('utf8'))
+        fc = fc.encode('utf8')
+        self.count = self.count + 1
+        rel = os.path.relpath(of, self.wdir).replace(os.sep, u'/')
+        self.written.add(rel)
+        self.digests[rel] = file_digest(fc)
+        if self.fragment:
+            fast_import_file(self.fragment, self.fragment_path + rel, fc)
+        try:
+            f = open(of, 'rb')
+            same = f.read() == fc
+            f.close()
+            if same:
+                return
+        except IOError:
+            pass
+        # Written next to the file and renamed over it, so that a file is
+        # never left half written.
+        f = open(of + u'.tmp', 'wb')
+        f.write(fc)
         f.close()
+        os.rename(of + u'.tmp', of)
+        self.bytes_written = self.bytes_written + len(fc)
+
+
+# With --xref-index, references to USLM identifiers that have a file of their
+# own (in any title) link to that file within the repository, instead of going
+# through the redirector. The index is built before the titles of a release
+# point are processed, by a quick pass over all of the title XMLs that only
+# looks at where the file delimiters would be, and kept in a database that the
+# workers read. Titles whose XML has not changed are not scanned again.
+class xref_index:
+    def __init__(self, path, readonly=False):
+        self.path = path
+        self.db = None
+        if readonly and not os.path.exists(path):
+            return
+        # The writer thread of a title does the lookups.
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        if readonly:
+            self.urls = lru_cache(LINK_CACHE_SIZE)
+            return
+        self.db.execute('CREATE TABLE IF NOT EXISTS info (name TEXT PRIMARY KEY, value TEXT)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS titles (title TEXT PRIMARY KEY, sha512xml TEXT, version TEXT)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS paths (identifier TEXT PRIMARY KEY, title TEXT, path TEXT, section INTEGER)')
+
+    # The XML digests of the titles indexed by this version of the software.
+    def known(self):
+        r = {}
+        for title, sha, version in self.db.execute('SELECT title, sha512xml, version FROM titles'):
+            if version == software_version():
+                r[title] = sha
+        return r
+
+    # paths are (identifier, path relative to the title's directory, whether
+    # it is section-like). An identifier can show up in more than one title
+    # (in quoted content, say); the title it belongs to wins. Within a title,
+    # the first file of a duplicated identifier wins over its ^extra ones.
+    def update(self, title, sha, paths):
+        owner = u'/us/usc/t' + title.lower().lstrip(u'0')
+        self.db.execute('DELETE FROM paths WHERE title = ?', (title, ))
+        seen = set()
+        for identifier, path, section in paths:
+            if identifier in seen:
+                continue
+            seen.add(identifier)
+            if identifier == owner or identifier.startswith(owner + u'/'):
+                self.db.execute('INSERT OR REPLACE INTO paths VALUES (?, ?, ?, ?)', (identifier, title, path, section))
+            else:
+                self.db.execute('INSERT OR IGNORE INTO paths VALUES (?, ?, ?, ?)', (identifier, title, path, section))
+        self.db.execute('INSERT OR REPLACE INTO titles VALUES (?, ?, ?)', (title, sha, software_version()))
+
+    # Digest of where each of hrefs goes, see lookup. The output of a title
+    # that links into the index is only stale when this changes for the hrefs
+    # it looked up, which the manifest keeps in usc<title>.xref.json.
+    def resolution_digest(self, hrefs):
+        h = hashlib.sha1()
+        for href in sorted(hrefs):
+            target = self.lookup(href)
+            if target:
+                target = target[0] + u' ' + target[1]
+            h.update((href + u' ' + (target or u'-') + u'\n').encode('utf-8'))
+        return unicode(h.hexdigest())
+
+    def close(self):
+        if self.db is None:
+            return
+        if not hasattr(self, 'urls'):
+            self.db.commit()
+        self.db.close()
+        self.db = None
+
+    # The title and path of the file for href, or None. A reference to part of
+    # a section (/us/usc/t42/s1983/a, say) goes to the section's file.
+    def lookup(self, href):
+        r = self.urls.get(href)
+        if r is None:
+            r = False
+            cid = unicode(href)
+            exact = True
+            while cid.count(u'/') >= 3:
+                row = self.db.execute('SELECT title, path, section FROM paths WHERE identifier = ?', (cid, )).fetchone()
+                if row:
+                    if exact or row[2]:
+                        r = (row[0], row[1])
+                    break
+                cid = cid.rsplit(u'/', 1)[0]
+                exact = False
+            self.urls.put(href, r)
+        return r or None
+
+# Names the files of a title from its file delimiters alone, with the same
+# code title_writer uses, but writes nothing. titlepath is only used in the
+# messages that delimit() builds for duplicate identifiers.
+class xref_recorder(title_writer):
+    def __init__(self, titlepath=u''):
+        title_writer.__init__(self, None, titlepath, None, None)
+        self.paths = []
+        # The dir and filename of each file, as given to write_file.
+        self.files = []
+
+    def issue(self, msg):
+        pass
+
+    def push(self, outs):
+        fd = outs[0]
+        path = (fd.dir + fd.filename).lstrip(u'/').replace(u'//', u'/')
+        # Sections are filed in the directory of the division they are in.
+        self.paths.append((fd.identifier, path, fd.dir != fd.identifier))
+        self.files.append((fd.dir, fd.filename))
+
+# Finds the file delimiters md_renderer would emit: every division (or
+# section) with an identifier, except within the meta, layouts and tables.
+XREF_SKIPPED = frozenset([RENDER_META, RENDER_LAYOUT, RENDER_TABLE])
+def scan_title_paths(source, titletrunc, titlepath=u''):
+    rec = xref_recorder(titlepath)
+    delimiters = 0
+    skip = 0
+    for event, elem in _xml.iterparse(source, ('start', 'end')):
+        kind = RENDER_KINDS.get(elem.tag)
+        if event == 'start':
+            if skip or kind in XREF_SKIPPED:
+                if kind in XREF_SKIPPED:
+                    skip = skip + 1
+            elif kind == RENDER_DIVISION and elem.get('identifier'):
+                cid = unicode(elem.get('identifier'))
+                delimiters = delimiters + 1
+                if elem.tag in TAGS_SECTION_LIKE:
+                    rec.delimit(FileDelimiter(identifier=cid, dir=None, uslmid=cid))
+                else:
+                    rec.delimit(FileDelimiter(identifier=cid, dir=cid, uslmid=cid))
+        else:
+            if kind in XREF_SKIPPED:
+                skip = skip - 1
+            elem.clear()
+    if not delimiters:
+        cid2 = (u"/us/usc/t" + titletrunc).lower()
+        rec.delimit(FileDelimiter(identifier=cid2, dir=cid2))
+    rec.delimit(FileDelimiter())
+    return rec.paths
+
+# Scans a title for build_xref_index, in a worker. Returns the title, its XML
+# digest, and its paths, or None if it need not (or cannot) be indexed again.
+class xref_scanner:
+    def __init__(self, zip_contents, known, rp1=None, rp2=None):
+        self.zip_contents = zip_contents
+        self.known = known
+        self.rp1 = rp1
+        self.rp2 = rp2
 
-    of = wdir + u'/README.md'
-    if issues:
-        issues = u'Issues: \n\n' + issues + '\n'
-    fc = _out_readme_markdown.substitute(
+    def __call__(self, title):
+        titlefilename = u"usc" + title + u".xml"
+        try:
+            xmlf = hashing_reader(open_title_xml(self.zip_contents, titlefilename))
+        except:
+            return (title, None, None)
+        while xmlf.read(HASH_CHUNK_SIZE):
+            pass
+        sha = xmlf.hexdigest()
+        xmlf.close()
+        if self.known.get(title) == sha:
+            return (title, sha, None)
+        titletrunc = title.lstrip(u'0')
+        fixups = input_fixups(self.rp1, self.rp2, title)
+        if [fx for fx in fixups if fx.lines is None]:
+            return (title, None, None)
+        source = open_title_xml(self.zip_contents, titlefilename)
+        if fixups:
+            source = fixup_reader(source, fixups)
+        try:
+            paths = scan_title_paths(source, titletrunc, self.zip_contents.zippath + u"/" + self.zip_contents.titledir + titlefilename)
+        except Exception as e:
+            # One title that cannot be indexed does not stop the others.
+            print u"(Non-Fatal) #### Could not index " + titlefilename + u" (" + unicode(e) + u"); references to it keep their previous links"
+            return (title, None, None)
+        return (title, sha, paths)
+
+def build_xref_index(pool, zip_contents, path, rp1=None, rp2=None):
+    index = xref_index(path)
+    scanner = xref_scanner(zip_contents, index.known(), rp1, rp2)
+    if pool:
+        results = list(pool.imap_unordered(scanner, ALL_TITLES))
+    else:
+        results = [scanner(title) for title in ALL_TITLES]
+    scanned = 0
+    for title, sha, paths in sorted(results):
+        if paths is not None:
+            index.update(title, sha, paths)
+            scanned = scanned + 1
+    index.close()
+    print "Indexed the files of " + str(scanned) + " titles in " + path
+
+
+# With --ir-cache, what title_writer is given to write for a title (each file's
+# FileDelimiter, fragments and links), along with the title's meta, issues and
+# element counts, is saved to <cache_dir>/usc<title>.ir. When only the page
+# templates or what write_file does with them have changed, the title is then
+# written again from there, without parsing and rendering its XML. The file is
+# keyed by the CRC and size of the title in the ZIP, so that looking it up
+# reads none of the XML, and by renderer_version; it also keeps the digest of
+# the XML, for the README.
+def ir_cache_path(options, title):
+    return options.cache_dir + u'/usc' + title + u'.ir'
+
+def title_zip_info(zip_contents, titlefilename):
+    zip = zipfile.ZipFile(zip_contents.zippath, 'r')
+    try:
+        return zip.getinfo(zip_contents.titledir + titlefilename)
+    finally:
+        zip.close()
+
+# Identifies the code that produces the intermediate form (and the offset
+# index of --section): like software_version, the source of this script, but
+# without the page templates and title_writer.write_file, which only shape what
+# is written from it. Any other change, to code or to data such as the escapes,
+# the tag sets or INPUT_FIXUPS, makes what was cached stale.
+_renderer_unused_re = re.compile(u'^_out_(header|readme)_markdown = Template\\(u""".*?"""\\)\n', re.M | re.S)
+_renderer_version = None
+def renderer_version():
+    global _renderer_version
+    if _renderer_version is None:
+        f = open(os.path.splitext(os.path.abspath(__file__))[0] + '.py', 'rb')
+        src = f.read().decode('utf-8')
+        f.close()
+        src = _renderer_unused_re.sub(u'', src)
+        src = src.replace(inspect.getsource(title_writer.write_file).decode('utf-8'), u'')
+        _renderer_version = unicode(hashlib.sha512(src.encode('utf-8')).hexdigest())
+    return _renderer_version
+
+# Each record is marshalled and compressed on its own, so that a title is
+# never held in memory at once. The header takes the first IR_HEADER_SIZE
+# bytes, and is only written by close(), once the XML has been read through
+# and its digest is known.
+IR_HEADER_SIZE = 1024
+class title_ir_writer:
+    def __init__(self, path, info):
+        self.path = path
+        self.key = (info.CRC, info.file_size)
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        self.f = open(path + u'.tmp', 'wb')
+        self.f.write(b'\0' * IR_HEADER_SIZE)
+
+    def record(self, r):
+        marshal.dump(zlib.compress(marshal.dumps(r), 1), self.f)
+
+    def dump(self, outs):
+        self.record((0, tuple(outs[0]), outs[1], [tuple(l) for l in outs[2]]))
+
+    def close(self, xmlsha, inputmeta, issues, writer_issues, counts):
+        self.record((1, inputmeta, issues, writer_issues, counts))
+        self.f.seek(0)
+        self.f.write(marshal.dumps((renderer_version(), ) + self.key + (xmlsha, )))
+        self.f.close()
+        os.rename(self.path + u'.tmp', self.path)
+
+# Returns the file positioned at the first record and the XML digest, or None
+# and None if there is no usable intermediate form of the title with the ZIP
+# entry info (and the XML digest, if it is known already).
+def open_title_ir(path, info, xmlsha=None):
+    try:
+        f = open(path, 'rb')
+    except IOError:
+        return None, None
+    try:
+        header = marshal.loads(f.read(IR_HEADER_SIZE))
+    except (EOFError, ValueError, TypeError):
+        header = None
+    if not isinstance(header, tuple) or header[:3] != (renderer_version(), info.CRC, info.file_size) or not (xmlsha is None or header[3] == xmlsha):
+        f.close()
+        return None, None
+    return f, header[3]
+
+# Gives each file to write, then returns the title's meta, issues, writer
+# issues and element counts.
+def replay_title_ir(f, write):
+    while True:
+        r = marshal.loads(zlib.decompress(marshal.load(f)))
+        if r[0] == 0:
+            write([FileDelimiter(*r[1]), r[2], [Link(*l) for l in r[3]]])
+        else:
+            f.close()
+            return r[1:]
+
+
+# With --section, the files of one division or section are written again
+# without parsing the rest of its title. A quick pass over the title XML with
+# expat, which builds no tree, finds the byte offsets of the elements that get
+# a file of their own (the ones scan_title_paths finds) and of the elements
+# they are in, and names their files. This is saved to
+# <cache_dir>/usc<title>.offsets, keyed by the CRC and size of the title in the
+# ZIP, so that it is found again without reading the XML at all.
+def offset_index_path(options, title):
+    return options.cache_dir + u'/usc' + title + u'.offsets'
+
+# Each node is [start, end, parent]: the offset of the start tag of an
+# element, the offset expat ends it at (that of its end tag, or just past it
+# if it is empty), and the index of the node it is in. Each delimiter is
+# (node, identifier, dir, filename), in document order.
+def build_offset_index(source, titlepath=u''):
+    rec = xref_recorder(titlepath)
+    nodes = []
+    delimiters = []
+    stack = []
+    skip = [0]
+    p = xml.parsers.expat.ParserCreate(namespace_separator='}')
+    def start(name, attrs):
+        tag = name
+        if u'}' in name:
+            tag = u'{' + name
+        kind = RENDER_KINDS.get(tag)
+        e = [p.CurrentByteIndex, None, kind]
+        stack.append(e)
+        if skip[0] or kind in XREF_SKIPPED:
+            if kind in XREF_SKIPPED:
+                skip[0] = skip[0] + 1
+        elif kind == RENDER_DIVISION and attrs.get(u'identifier'):
+            parent = None
+            for a in stack:
+                if a[1] is None:
+                    a[1] = len(nodes)
+                    nodes.append([a[0], None, parent])
+                parent = a[1]
+            cid = unicode(attrs.get(u'identifier'))
+            delimiters.append(e[1])
+            if tag in TAGS_SECTION_LIKE:
+                rec.delimit(FileDelimiter(identifier=cid, dir=None, uslmid=cid))
+            else:
+                rec.delimit(FileDelimiter(identifier=cid, dir=cid, uslmid=cid))
+    def end(name):
+        e = stack.pop()
+        if e[2] in XREF_SKIPPED:
+            skip[0] = skip[0] - 1
+        if e[1] is not None:
+            nodes[e[1]][1] = p.CurrentByteIndex
+    p.StartElementHandler = start
+    p.EndElementHandler = end
+    p.ParseFile(source)
+    rec.delimit(FileDelimiter())
+    return {
+        u'nodes': nodes,
+        u'delimiters': [(n, rec.paths[i][0]) + rec.files[i] for i, n in enumerate(delimiters)],
+    }
+
+def save_offset_index(path, key, index):
+    if not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    f = open(path + u'.tmp', 'wb')
+    marshal.dump(key, f)
+    marshal.dump(index, f)
+    f.close()
+    os.rename(path + u'.tmp', path)
+
+def load_offset_index(path, key):
+    try:
+        f = open(path, 'rb')
+    except IOError:
+        return None
+    try:
+        if marshal.load(f) != key:
+            return None
+        return marshal.load(f)
+    except (EOFError, ValueError, TypeError):
+        return None
+    finally:
+        f.close()
+
+# Reads a file that cannot seek, such as a member of a ZIP, at offsets that
+# never go back: what is before them is read and dropped.
+class forward_reader:
+    def __init__(self, f):
+        self.f = f
+        self.base = 0
+        self.buf = b''
+
+    def read(self, offset, size=-1):
+        while self.base + len(self.buf) < offset:
+            self.base = self.base + len(self.buf)
+            self.buf = self.f.read(min(HASH_CHUNK_SIZE, offset - self.base))
+            if not self.buf:
+                break
+        self.buf = self.buf[offset - self.base:]
+        self.base = offset
+        if size < 0:
+            self.buf = self.buf + self.f.read()
+            return self.buf
+        while len(self.buf) < size:
+            data = self.f.read(size - len(self.buf))
+            if not data:
+                break
+            self.buf = self.buf + data
+        return self.buf[:size]
+
+    def close(self):
+        self.f.close()
+
+_start_tag_re = re.compile(r'<([^\s/>]+)(?:\s+[^\s=/>]+\s*=\s*(?:"[^"]*"|\'[^\']*\'))*\s*/?>')
+def read_start_tag(r, offset):
+    size = 1024
+    while True:
+        data = r.read(offset, size)
+        m = _start_tag_re.match(data)
+        if m or len(data) < size:
+            break
+        size = size * 2
+    if not m:
+        print u"(FATAL) #### No start tag at offset " + str(offset)
+        assert(False)
+        sys.exit(2)
+    return m.group(0)
+
+# Returns the XML of the files of delimiters first to last of a title as a
+# document of its own: its prolog and the start tags of the elements the
+# first is in, then everything from the start tag of the first to that of the
+# delimiter after the last (or to the end of the title), then the end tags
+# of the elements that one is in. As the files of last take everything up to
+# the next delimiter, the tails of the elements they close and any elements
+# in between are there too. The first file of a title also takes whatever
+# comes before the first delimiter, so for that one the document starts with
+# all of the title up to there. Also returns how many delimiters the document
+# starts with before first (-1 when all that comes before it is to be kept),
+# and how many end tags were added.
+def read_title_span(source, index, first, last):
+    nodes = index[u'nodes']
+    delimiters = index[u'delimiters']
+    delimiting = set([d[0] for d in delimiters])
+    def ancestors(n):
+        chain = []
+        n = nodes[n][2]
+        while n is not None:
+            chain.insert(0, n)
+            n = nodes[n][2]
+        return chain
+    target = delimiters[first][0]
+    outer = ancestors(target)
+    inner = []
+    if last + 1 < len(delimiters):
+        inner = ancestors(delimiters[last + 1][0])
+    r = forward_reader(source)
+    start = nodes[target][0]
+    tags = {}
+    if first == 0:
+        doc = [r.read(0, start)]
+        for n in outer:
+            tags[n] = _start_tag_re.match(doc[0], nodes[n][0]).group(0)
+    else:
+        doc = [r.read(0, nodes[0][0])]
+        for n in outer:
+            tags[n] = read_start_tag(r, nodes[n][0])
+            doc.append(tags[n])
+    if inner:
+        span = r.read(start, nodes[delimiters[last + 1][0]][0] - start)
+    else:
+        span = r.read(start)
+    r.close()
+    doc.append(span)
+    for n in reversed(inner):
+        if n in tags:
+            m = _start_tag_re.match(tags[n])
+        else:
+            m = _start_tag_re.match(span, nodes[n][0] - start)
+        doc.append(b'</' + m.group(1) + b'>')
+    if first == 0:
+        return b''.join(doc), -1, len(inner)
+    return b''.join(doc), len([n for n in outer if n in delimiting]), len(inner)
+
+# Renders a document from read_title_span, passing on only what belongs to the
+# files in it: from the delimiter after the first skip ones (or from the
+# start if skip is -1), up to where the first of the closes elements whose end
+# tags were added is closed.
+class span_renderer(md_renderer):
+    def __init__(self, sink, meta, skip, closes):
+        md_renderer.__init__(self, self.gate, meta)
+        self.out = sink
+        self.skip = skip
+        self.closes = closes
+        self.stop = set()
+        self.done = False
+
+    def render(self, root):
+        # Those elements are the last ones of each level, from the root in.
+        e = root
+        for i in xrange(self.closes):
+            if i:
+                e = e[-1]
+            self.stop.add(e)
+        self.element(root, False, False)
+
+    def gate(self, o):
+        if self.skip >= 0:
+            if isinstance(o, FileDelimiter):
+                self.skip = self.skip - 1
+            if self.skip >= 0:
+                return
+        if not self.done:
+            self.out(o)
+
+    def close(self, f):
+        if f.elem in self.stop:
+            self.done = True
+        md_renderer.close(self, f)
+
+# Writes the files of delimiters first to last of a title just as title_writer
+# does for the whole title, given their neighbours in the offset index, and
+# leaves the other files of the title alone.
+class section_writer(title_writer):
+    def __init__(self, wdir, titlepath, titletrunc, fancytitle, files, first, last):
+        title_writer.__init__(self, wdir, titlepath, titletrunc, fancytitle)
+        self.files = files
+        self.first = first
+        self.last = last
+        self.lastdir = files[first][0]
+        for d, fn in files[:first]:
+            self.allfullcids.add(d + u'/' + fn)
+        self.pushed = 0
+
+    def push(self, outs):
+        fd = outs[0]
+        if self.first + self.pushed > self.last or (fd.dir, fd.filename) != tuple(self.files[self.first + self.pushed]):
+            print u"(FATAL) #### The offset index does not match " + self.titlepath + u" at " + fd.identifier
+            assert(False)
+            sys.exit(2)
+        if self.pending is None and self.first > 0:
+            d, fn = self.files[self.first - 1]
+            outs[0] = fd._replace(prev = fd.titleroot + d + fn)
+        self.pushed = self.pushed + 1
+        title_writer.push(self, outs)
+
+    def close(self):
+        self.delimit(FileDelimiter())
+        if self.pending and self.last + 1 < len(self.files):
+            d, fn = self.files[self.last + 1]
+            fd = self.pending[0]
+            self.pending[0] = fd._replace(next = fd.titleroot + d + fn)
+        self.finish()
+
+    def prune(self):
+        pass
+
+# rp1 and rp2 are only needed for titles with input fixups.
+def process_section(zip_contents, identifier, rp1, rp2, wd, options=TitleOptions()):
+    started = time.time()
+    use_xml_backend(options.parser)
+    identifier = unicode(identifier)
+    m = re.match(u'/us/usc/t([0-9]+)([a-z]?)(/|$)', identifier, re.I)
+    titles = []
+    if m:
+        titles = [t for t in ALL_TITLES if t.lower() == (m.group(1).zfill(2) + m.group(2)).lower()]
+    if not titles:
+        print u"(FATAL) #### No title for identifier " + identifier
+        assert(False)
+        sys.exit(2)
+    title = titles[0]
+    titlefilename = u"usc" + title + u".xml"
+    titlepath = zip_contents.zippath + u"/" + zip_contents.titledir + titlefilename
+    titletrunc = title.lstrip(u'0')
+    fancytitle = titletrunc + u' U.S.C.'
+    if title.endswith(u'A') or title.endswith(u'a'):
+        fancytitle = u"Appendix to " + titletrunc[:-1] + u' U.S.C.'
+    wdir = wd + u'/gen/titles/usc' + title
+    repairs = input_repairs(rp1, rp2, title)
+    def open_source():
+        source = open_title_xml(zip_contents, titlefilename)
+        if repairs:
+            source = fixup_reader(source, repairs)
+        return source
+
+    try:
+        info = title_zip_info(zip_contents, titlefilename)
+    except KeyError:
+        print u"(FATAL) #### Could not read title " + title
+        assert(False)
+        sys.exit(2)
+    # Offsets are into the XML as repaired.
+    key = (renderer_version(), info.CRC, info.file_size, [sorted(fx.lines.items()) for fx in repairs])
+    path = offset_index_path(options, title)
+    index = load_offset_index(path, key)
+    if index is None:
+        try:
+            index = build_offset_index(open_source(), titlepath)
+        except xml.parsers.expat.ExpatError as e:
+            print u"(FATAL) #### FAILURE TO PARSE " + titlepath + u": " + unicode(e)
+            raise
+        save_offset_index(path, key, index)
+        print "Indexed " + str(len(index[u'delimiters'])) + " files of title " + str(title) + " in " + path
+
+    delimiters = index[u'delimiters']
+    found = [i for i, d in enumerate(delimiters) if d[1] == identifier]
+    if not found:
+        print u"(FATAL) #### " + identifier + u" does not have a file of its own in " + titlepath
+        assert(False)
+        sys.exit(2)
+    if len(found) > 1:
+        print u"(Non-Fatal) #### Duplicate USLM identifier " + identifier + u" at " + titlepath + u"; writing the first"
+    first = found[0]
+    # The delimiters within it, which all start before it ends.
+    nodes = index[u'nodes']
+    end = nodes[delimiters[first][0]][1]
+    last = first
+    while last + 1 < len(delimiters) and nodes[delimiters[last + 1][0]][0] < end:
+        last = last + 1
+
+    doc, skip, closes = read_title_span(open_source(), index, first, last)
+    try:
+        root = _xml.parse(StringIO.StringIO(doc))
+    except:
+        print u"(FATAL) #### FAILURE TO PARSE " + identifier + u" in " + titlepath
+        raise
+
+    writer = section_writer(wdir, titlepath, titletrunc, fancytitle, [d[2:] for d in delimiters], first, last)
+    writer.dedupe_links = bool(options.dedupe_links)
+    if options.xref_index:
+        writer.xref = xref_index(options.xref_index, readonly=True)
+        if writer.xref.db is None:
+            writer.xref = None
+    span_renderer(writer.add, [], skip, closes).render(root)
+    writer.close()
+    if writer.xref:
+        writer.xref.close()
+    print "Wrote " + str(writer.count) + " files (" + str(writer.bytes_written) + " bytes changed) for " + identifier + " in %.3fs" % (time.time() - started)
+
+
+def tag_name(tag):
+    if tag.startswith(_sp):
+        return tag[len(_sp):]
+    if tag.startswith(_shtml):
+        return u'xhtml:' + tag[len(_shtml):]
+    return tag
+
+# What process_title returns, and what the run report lists for each title.
+# Its status is one of missing, unchanged or rendered; its change is
+# how the output changed since the title's last manifest entry, see
+# classify_title_change, and its file_changes how many files were changed,
+# added and removed, see count_file_changes.
+def title_result(title, options, status, started, timer, **fields):
+    r = {
+        u'title': title,
+        u'status': status,
+        u'pid': os.getpid(),
+        u'seconds': time.time() - started,
+        u'stages': timer.report(),
+        u'peak_rss_kb': peak_rss_kb(),
+        u'files': 0,
+        u'bytes_written': 0,
+        u'elements': {},
+        u'issues': [],
+        u'change': None,
+        u'file_changes': None,
+        u'fast_import': False,
+    }
+    r.update(fields)
+    return r
+
+def process_title(zip_contents, title, rp1, rp2, notice, wd, options=TitleOptions()):
+    started = time.time()
+    reset_peak_rss()
+    use_xml_backend(options.parser)
+    timer = stage_timer(u'other')
+    rp1 = unicode(rp1)
+    rp2 = unicode(rp2)
+    notice = unicode(notice)
+    title = unicode(title)
+    wdir = wd + u'/gen/titles/usc' + title
+    issues = u''
+    zipurl = _download_url_template.substitute(rp1 = rp1, rp2 = rp2)
+    titlefilename = u"usc" + title + u".xml"
+    titlepath = zip_contents.zippath + u"/" + zip_contents.titledir + titlefilename
+    xmlsha = None
+
+    # The digest is taken as the parser reads the file, see hashing_reader.
+    try:
+        xmlf = hashing_reader(open_title_xml(zip_contents, titlefilename), timer)
+    except:
+        print u"(Non-Fatal) #### Skipping; Could not read title " + str(title)
+        return title_result(title, options, u'missing', started, timer, issues = [u"Could not read title " + title])
+
+    repairs = input_repairs(rp1, rp2, title)
+
+    titletrunc = title
+    while titletrunc.startswith(u'0'):
+        titletrunc = titletrunc[1:]
+
+    isappendix = title.endswith(u'A') or title.endswith(u'a')
+
+    fancytitle = titletrunc + u' U.S.C.'
+    if isappendix:
+        fancytitle = u"Appendix to " + titletrunc[:-1] + u' U.S.C.'
+
+    if options.incremental:
+        xmlsha = xmlf.hexdigest()
+        xmlf.close()
+        entry = read_manifest_entry(options.manifest_dir, title)
+        # The links of a title change with where its references go in the
+        # index they were made from.
+        xref = None
+        if options.xref_index:
+            index = xref_index(options.xref_index, readonly=True)
+            if index.db is not None:
+                xref = index.resolution_digest(read_manifest_entry(options.manifest_dir, title + u'.xref') or [])
+            index.close()
+        # So do they with --dedupe-links; an entry without it is rendered again.
+        if entry and entry[u'sha512xml'] == xmlsha and entry[u'version'] == software_version() and os.path.isdir(entry[u'outdir']) and entry.get(u'xref') == xref and entry.get(u'dedupe_links') == bool(options.dedupe_links):
+            # Only the release point metadata in the README can differ.
+            if os.path.abspath(entry[u'outdir']) != os.path.abspath(wdir):
+                if os.path.exists(wdir):
+                    shutil.rmtree(wdir)
+                shutil.copytree(entry[u'outdir'], wdir)
+            old = dict(entry)
+            fc = write_title_readme(wdir, entry[u'issues'],
+                    rp1 = rp1,
+                    rp2 = rp2,
+                    url = zipurl,
+                    sha512zip = zip_contents.sha512,
+                    titlefile = titlefilename,
+                    sha512xml = xmlsha,
+                    notice = notice,
+                    origmd = entry[u'origmd'],
+                    title = title,
+                    index = entry[u'index'],
+                    titletrunc = titletrunc,
+                    fancytitle = fancytitle,
+            )
+            entry[u'outdir'] = os.path.abspath(wdir)
+            entry[u'readme_digest'] = file_digest(fc)
+            write_manifest_entry(options.manifest_dir, title, entry)
+            if entry.get(u'content_digest') is not None:
+                files = read_manifest_files(options.manifest_dir, title)
+                files[u'README.md'] = entry[u'readme_digest']
+                write_manifest_entry(options.manifest_dir, title, files, u'.files.json')
+            if options.fast_import_prefix is not None:
+                # None of the other files changed, and none were removed.
+                f = open_fast_import_fragment(wd, title, options.fast_import_prefix, not options.fast_import_base)
+                if options.fast_import_base:
+                    fast_import_file(f, options.fast_import_prefix + u'usc' + title + u'/README.md', fc)
+                else:
+                    fast_import_tree(f, options.fast_import_prefix, title, wdir)
+                f.close()
+            print "Unchanged title " + str(title) + "; only refreshed README.md"
+            return title_result(title, options, u'unchanged', started, timer, files = entry[u'count'],
+                    change = classify_title_change(old, entry), fast_import = options.fast_import_prefix is not None,
+                    file_changes = [int(old.get(u'readme_digest') != entry[u'readme_digest']), 0, 0])
+        xmlf = hashing_reader(open_title_xml(zip_contents, titlefilename), timer)
+
+    irf = None
+    if options.ir_cache:
+        xmlinfo = title_zip_info(zip_contents, titlefilename)
+        irf, irsha = open_title_ir(ir_cache_path(options, title), xmlinfo, xmlsha)
+        if irf:
+            # None of the XML is read.
+            xmlsha = irsha
+            xmlf.close()
+
+    # The digest is still that of the XML as published.
+    source = xmlf
+    fixer = None
+    if repairs:
+        fixer = fixup_reader(source, repairs)
+        source = fixer
+
+    cachepath = options.cache_dir + u'/usc' + title + u'.sqlite'
+
+    # Any previous output is updated in place, see title_writer.
+    if not os.path.isdir(wdir):
+        os.makedirs(wdir)
+
+    print "Starting title " + str(title)
+
+    writer = title_writer(wdir, titlepath, titletrunc, fancytitle, timer, options.write_queue)
+    meta = []
+    counts = {}
+    try:
+        writer.dedupe_links = bool(options.dedupe_links)
+        if options.xref_index:
+            writer.xref = xref_index(options.xref_index, readonly=True)
+            if writer.xref.db is None:
+                writer.xref = None
+        if options.fast_import_prefix is not None:
+            writer.fragment = open_fast_import_fragment(wd, title, options.fast_import_prefix)
+            writer.fragment_path = options.fast_import_prefix + u'usc' + title + u'/'
+        if options.ir_cache and not irf:
+            writer.ir = title_ir_writer(ir_cache_path(options, title), xmlinfo)
+        if irf:
+            timer.enter(u'load')
+            inputmeta, issues, writer.issues, counts = replay_title_ir(irf, writer.write)
+            meta.append(inputmeta)
+            timer.leave()
+            print "Writing title " + str(title) + " from its cached intermediate form"
+        elif options.streaming or options.section_cache:
+            cache = None
+            render = None
+            if options.section_cache:
+                if not os.path.exists(os.path.dirname(cachepath)):
+                    os.makedirs(os.path.dirname(cachepath))
+                cache = section_cache(cachepath)
+                render = cache.render
+            timer.enter(u'parse')
+            try:
+                for o in stream_title(source, meta, timed_render(timer, render), counts):
+                    writer.add(o)
+            except SyntaxError:
+                print u"(FATAL) #### FAILURE TO PARSE " + titlepath
+                raise
+            timer.leave()
+            if cache:
+                cache.close()
+                print "Reused " + str(cache.hits) + " of " + str(cache.hits + cache.misses) + " cached sections for title " + str(title)
+        else:
+            timer.enter(u'parse')
+            try:
+                origxml = _xml.parse(source)
+            except:
+                print u"(FATAL) #### FAILURE TO PARSE " + titlepath
+                raise
+            for e in origxml.iter():
+                counts[e.tag] = counts.get(e.tag, 0) + 1
+            timer.leave()
+
+            timer.enter(u'render')
+            md_renderer(writer.add, meta).element(origxml, False, False)
+            timer.leave()
+            origxml = None
+        if fixer:
+            for fx in fixer.applied:
+                print u"(Non-Fatal) #### " + u"ISSUE WITH " + titlepath + u": " + fx.issue
+                issues = issues + fx.issue
+        if irf:
+            timer.enter(u'split')
+            writer.finish()
+            timer.leave()
+        else:
+            writer.close()
+    finally:
+        writer.stop()
+    if irf is None:
+        xmlsha = xmlf.hexdigest()
+    xmlf.close()
+    if writer.ir:
+        writer.ir.close(xmlsha, u''.join(meta), issues, writer.issues, counts)
+    xref = None
+    if writer.xref:
+        xref = writer.xref.resolution_digest(writer.xref_hrefs)
+        writer.xref.close()
+    inputmeta = u''.join(meta)
+
+    fc = write_title_readme(wdir, issues,
             rp1 = rp1,
             rp2 = rp2,
             url = zipurl,
@@ -856,31 +2506,438 @@ def process_title(zip_contents, title, rp1, rp2, notice, wd):
             titlefile = titlefilename,
             sha512xml = xmlsha,
             notice = notice,
-            issues = issues,
-            origmd = p.inputmeta,
+            origmd = inputmeta,
             title = title,
-            index = index,
+            index = writer.index,
             titletrunc = titletrunc,
             fancytitle = fancytitle,
     )
-    f = open(of, 'w')
-    f.write(fc.encode('utf8'))
-    f.close()
+    if writer.fragment:
+        fast_import_file(writer.fragment, writer.fragment_path + u'README.md', fc)
+        writer.fragment.close()
+
+    change = None
+    filechanges = None
+    if options.manifest_dir:
+        entry = {
+                u'title': title,
+                u'sha512xml': xmlsha,
+                u'version': software_version(),
+                u'outdir': os.path.abspath(wdir),
+                u'count': writer.count,
+                u'issues': issues,
+                u'origmd': inputmeta,
+                u'index': writer.index,
+                u'seconds': time.time() - started,
+                u'peak_rss_kb': peak_rss_kb(),
+                u'content_digest': content_digest(writer.digests),
+                u'xref': xref,
+                u'dedupe_links': bool(options.dedupe_links),
+                u'readme_digest': file_digest(fc),
+        }
+        change = classify_title_change(read_manifest_entry(options.manifest_dir, title), entry)
+        writer.digests[u'README.md'] = entry[u'readme_digest']
+        filechanges = count_file_changes(read_manifest_files(options.manifest_dir, title), writer.digests)
+        write_manifest_entry(options.manifest_dir, title, writer.digests, u'.files.json')
+        if writer.xref:
+            write_manifest_entry(options.manifest_dir, title, sorted(writer.xref_hrefs), u'.xref.json')
+        write_manifest_entry(options.manifest_dir, title, entry)
+
+    print "Finished " + str(writer.count) + " entries for title " + str(title)
+    elements = {}
+    for tag in counts:
+        elements[tag_name(tag)] = counts[tag]
+    return title_result(title, options, u'rendered', started, timer,
+            files = writer.count,
+            bytes_written = writer.bytes_written,
+            elements = elements,
+            issues = [l[2:] for l in issues.splitlines()] + writer.issues,
+            change = change,
+            file_changes = filechanges,
+            fast_import = options.fast_import_prefix is not None,
+    )
 
-    print "Finished " + str(inc) + " entries for title " + str(title)
 
+# Counts the stacks seen every interval seconds of CPU time, using SIGPROF.
+# They are saved in the collapsed format of flame graph tools: the frames from
+# the outermost in, separated by ;, then a space and the count.
+class stack_sampler:
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.counts = {}
+
+    def sample(self, signum, frame):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append(os.path.basename(code.co_filename) + u':' + code.co_name)
+            frame = frame.f_back
+        stack.reverse()
+        key = u';'.join(stack)
+        self.counts[key] = self.counts.get(key, 0) + 1
+
+    def start(self):
+        signal.signal(signal.SIGPROF, self.sample)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def stop(self):
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        signal.signal(signal.SIGPROF, signal.SIG_DFL)
+
+    def dump(self, path):
+        f = codecs.open(path, 'w', 'utf-8')
+        for key in sorted(self.counts):
+            f.write(key + u' ' + unicode(self.counts[key]) + u'\n')
+        f.close()
+
+# Runs fn under the profiler of the given mode (cprofile or sample) and saves
+# the profile to path plus .prof or .stacks.
+def profiled(path, mode, fn, *args):
+    if not os.path.exists(os.path.dirname(path)):
+        try:
+            os.makedirs(os.path.dirname(path))
+        except OSError:
+            if not os.path.isdir(os.path.dirname(path)):
+                raise
+    if mode == u'sample':
+        sampler = stack_sampler()
+        sampler.start()
+        try:
+            return fn(*args)
+        finally:
+            sampler.stop()
+            sampler.dump(path + u'.stacks')
+    prof = cProfile.Profile()
+    try:
+        return prof.runcall(fn, *args)
+    finally:
+        prof.dump_stats(path + u'.prof')
+
+# Combines the profiles of all titles under profile_dir (see --profile) into
+# merged.prof and merged.stacks there, and prints the top of each.
+def merge_profiles(profile_dir):
+    profs = []
+    # A title that took less than one interval has an empty stacks file.
+    stackfiles = 0
+    stacks = {}
+    for dirpath, dirnames, filenames in os.walk(profile_dir):
+        for fn in sorted(filenames):
+            path = os.path.join(dirpath, fn)
+            if fn.startswith('merged.'):
+                continue
+            if fn.endswith('.prof'):
+                profs.append(path)
+            elif fn.endswith('.stacks'):
+                stackfiles = stackfiles + 1
+                f = codecs.open(path, 'r', 'utf-8')
+                for line in f:
+                    if not line.strip():
+                        continue
+                    key, count = line.rstrip(u'\n').rsplit(u' ', 1)
+                    stacks[key] = stacks.get(key, 0) + int(count)
+                f.close()
+    if not profs and not stackfiles:
+        print u"(FATAL) #### No profiles found in " + profile_dir
+        assert(False)
+        sys.exit(2)
+    if profs:
+        st = pstats.Stats(*profs)
+        st.dump_stats(os.path.join(profile_dir, 'merged.prof'))
+        print "Merged " + str(len(profs)) + " profiles into " + os.path.join(profile_dir, 'merged.prof')
+        st.sort_stats('cumulative').print_stats(30)
+        st.sort_stats('tottime').print_stats(30)
+    if stackfiles:
+        f = codecs.open(os.path.join(profile_dir, 'merged.stacks'), 'w', 'utf-8')
+        total = 0
+        leaves = {}
+        for key in sorted(stacks):
+            f.write(key + u' ' + unicode(stacks[key]) + u'\n')
+            total = total + stacks[key]
+            leaf = key.rsplit(u';', 1)[-1]
+            leaves[leaf] = leaves.get(leaf, 0) + stacks[key]
+        f.close()
+        print "Merged " + str(total) + " samples into " + os.path.join(profile_dir, 'merged.stacks')
+        for leaf in sorted(leaves, key=lambda l: leaves[l], reverse=True)[:30]:
+            print "%6.2f%%  %s" % (100.0 * leaves[leaf] / total, leaf)
+
+# What a pool worker raises when a title fails. The exceptions of the parsers
+# cannot be relied on to cross back to the parent: cElementTree's cannot be
+# pickled, and lxml's cannot be unpickled, which stops the pool for good.
+class title_failure(Exception):
+    def __init__(self, title, message):
+        Exception.__init__(self, title, message)
+        self.title = title
+        self.message = message
 
 class title_processor:
-    def __init__(self, z, rp1, rp2, notice, working_directory):
+    def __init__(self, z, rp1, rp2, notice, working_directory, options):
         self.z = z
         self.rp1 = rp1
         self.rp2 = rp2
         self.notice = notice
         self.working_directory = working_directory
+        self.options = options
 
     def __call__(self, title):
-        process_title(self.z, title, self.rp1, self.rp2, self.notice, self.working_directory)
-        return u"Processor for " + title + u" complete."
+        try:
+            return self.process(title)
+        except Exception:
+            raise title_failure(title, unicode(traceback.format_exc(), 'utf-8', 'replace'))
+
+    def process(self, title):
+        options = self.options
+        if options.profile_dir:
+            path = options.profile_dir + u'/' + unicode(self.rp1) + u'-' + unicode(self.rp2) + u'/usc' + title
+            return profiled(path, options.profile_mode, process_title, self.z, title, self.rp1, self.rp2, self.notice, self.working_directory, options)
+        return process_title(self.z, title, self.rp1, self.rp2, self.notice, self.working_directory, options)
+
+ALL_TITLES = sorted("01 02 03 04 05 06 07 08 09 10 11 12 13 14 15 16 17 18 19 20 21 22 23 24 25 26 27 28 29 30 31 32 33 34 35 36 37 38 39 40 41 42 43 44 45 46 47 48 49 50 51 52 53 54 55 56 57 58 59 60 05A 11A 18A 28a 50A".split())
+
+# The commit of uscode-software that generated the output, for commit messages,
+# as update-repo.sh has it.
+_software_commit = None
+def software_commit():
+    global _software_commit
+    if _software_commit is None:
+        gitdir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '.git')
+        try:
+            _software_commit = unicode(subprocess.check_output(['git', '--git-dir=' + gitdir, 'rev-parse', 'HEAD']).strip())
+        except (OSError, subprocess.CalledProcessError):
+            _software_commit = u'unknown'
+    return _software_commit
+
+# The summary update-repo.sh appends to its commit messages is git's diffstat
+# of the commit; this one counts the files of the results instead.
+def file_change_summary(results):
+    counts = [0, 0, 0]
+    for r in results:
+        for i, n in enumerate(r[u'file_changes'] or []):
+            counts[i] = counts[i] + n
+    return u": %d files changed, %d added, %d removed" % tuple(counts)
+
+# Commits the titles of a release point that have a fast-import fragment, in
+# title order, with update-repo.sh's commit messages: each title whose content
+# changed gets a commit of its own, and the titles where only the metadata
+# changed (or nothing did) go together into one last commit.
+def fast_import_release_point(stream, wd, rp1, rp2, results):
+    rel = u"(Rel " + unicode(rp1) + u"-" + unicode(rp2) + u") "
+    generated = u"\n\nGenerated with https://github.com/publicdocs/uscode-software/tree/" + software_commit() + u"\n"
+    minor = []
+    for r in sorted(results, key=lambda r: r[u'title']):
+        if not r[u'fast_import']:
+            continue
+        if r[u'change'] in [u'metadata', u'unchanged']:
+            minor.append(r)
+            continue
+        fragment = fast_import_fragment_path(wd, r[u'title'])
+        stream.commit(rel + r[u'title'] + u" U.S.C." + file_change_summary([r]) + generated, [fragment])
+        os.remove(fragment)
+    if minor:
+        fragments = [fast_import_fragment_path(wd, r[u'title']) for r in minor]
+        stream.commit(rel + u"Minor updates to U.S.C. titles: " + u" ".join([r[u'title'] for r in minor]) + file_change_summary(minor) + generated, fragments)
+        for fragment in fragments:
+            os.remove(fragment)
+
+def result_message(r):
+    return u"Processor for " + r[u'title'] + u" complete."
+
+# Writes <report_dir>/<rp1>-<rp2>.json, with the results of all the tasks of a
+# release point (see title_result) and their totals.
+def write_run_report(report_dir, rp1, rp2, zipinfo, jobs, started, results):
+    totals = {u'files': 0, u'bytes_written': 0, u'stages': {}, u'elements': 0, u'statuses': {}, u'changes': {}}
+    for r in results:
+        totals[u'files'] = totals[u'files'] + r[u'files']
+        totals[u'bytes_written'] = totals[u'bytes_written'] + r[u'bytes_written']
+        totals[u'elements'] = totals[u'elements'] + sum(r[u'elements'].values())
+        totals[u'statuses'][r[u'status']] = totals[u'statuses'].get(r[u'status'], 0) + 1
+        if r[u'change']:
+            totals[u'changes'][r[u'change']] = totals[u'changes'].get(r[u'change'], 0) + 1
+        for stage in r[u'stages']:
+            t = totals[u'stages'].setdefault(stage, {u'wall': 0.0, u'cpu': 0.0})
+            t[u'wall'] = t[u'wall'] + r[u'stages'][stage][u'wall']
+            t[u'cpu'] = t[u'cpu'] + r[u'stages'][stage][u'cpu']
+    report = {
+        u'rp1': unicode(rp1),
+        u'rp2': unicode(rp2),
+        u'zip': zipinfo.zippath,
+        u'sha512zip': zipinfo.sha512,
+        u'version': software_version(),
+        u'jobs': jobs,
+        u'started': started,
+        u'seconds': time.time() - started,
+        u'peak_rss_kb': max([r[u'peak_rss_kb'] for r in results] + [peak_rss_kb()]),
+        u'totals': totals,
+        u'titles': sorted(results, key=lambda r: r[u'title']),
+    }
+    if not os.path.exists(report_dir):
+        os.makedirs(report_dir)
+    path = report_dir + u'/' + unicode(rp1) + u'-' + unicode(rp2) + u'.json'
+    f = open(path + u'.tmp', 'w')
+    json.dump(report, f, indent=2, sort_keys=True)
+    f.close()
+    os.rename(path + u'.tmp', path)
+    print "Wrote run report " + path
+
+# Runs tasks on pool, in order, at most jobs at a time. With a budget, a task
+# only starts once the memory it is estimated to need (in KB) fits in budget
+# alongside the tasks that are running; a task that does not fit is held back
+# while later, smaller ones may start. A task runs anyway when nothing else
+# is. Yields the results as tasks finish.
+def run_admitted(pool, fn, tasks, jobs, memory=None, budget=None):
+    pending = list(tasks)
+    running = []
+    used = 0
+    held = set()
+    while pending or running:
+        for task in list(pending):
+            if len(running) >= jobs:
+                break
+            need = 0
+            if budget:
+                need = memory(task)
+            if running and budget and used + need > budget:
+                if not (task in held):
+                    held.add(task)
+                    print "Holding back " + task + " (about " + str(int(need / 1024)) + " MB) until memory frees up"
+                continue
+            pending.remove(task)
+            used = used + need
+            running.append((pool.apply_async(fn, (task, )), need, task))
+        done = [rn for rn in running if rn[0].ready()]
+        if not done:
+            running[0][0].wait(0.1)
+            continue
+        for rn in done:
+            running.remove(rn)
+            used = used - rn[1]
+            yield rn[0].get()
+
+# Processes the titles of one release point, with pool if given, or else with a
+# pool of its own if there is more than one task.
+def process_release_point(pool, zipinfo, rp1, rp2, notice, wd, titles, options, args, stream=None):
+    started = time.time()
+    at = titles
+    if not at:
+        at = ALL_TITLES
+    cost, sizes, memory = estimate_title_costs(zipinfo, at, options.manifest_dir)
+    tasks = sorted(at, key=lambda t: cost[t], reverse=True)
+    if stream:
+        # The first commit of a new history starts from an empty tree.
+        options = options._replace(fast_import_base = stream.parent is not None or stream.commits > 0)
+    results = []
+    jobs = 1
+    ownpool = False
+    if pool is None and len(tasks) > 1:
+        ownpool = True
+        jobs = max(1, min(args.jobs, len(tasks)))
+        pool = Pool(jobs)
+    elif pool:
+        jobs = args.jobs
+    if options.xref_index:
+        build_xref_index(pool, zipinfo, options.xref_index, unicode(rp1), unicode(rp2))
+    if pool is None:
+        results.append(title_processor(zipinfo, rp1, rp2, notice, wd, options)(tasks[0]))
+    else:
+        tp = title_processor(zipinfo, rp1, rp2, notice, wd, options)
+        budget = None
+        if args.max_memory:
+            budget = args.max_memory * 1024
+        if budget:
+            rs = run_admitted(pool, tp, tasks, jobs, lambda t: memory[t], budget)
+        else:
+            rs = pool.imap_unordered(tp, tasks)
+        try:
+            for r in rs:
+                print result_message(r)
+                results.append(r)
+        except title_failure as e:
+            print e.message
+            print u"(FATAL) #### Title " + e.title + u" failed, see above"
+            pool.terminate()
+            assert(False)
+            sys.exit(2)
+        if ownpool:
+            pool.close()
+            pool.join()
+    if not (options.incremental or options.section_cache):
+        prune_output(wd, results)
+    write_run_report(options.report_dir, rp1, rp2, zipinfo, jobs, started, results)
+    if stream:
+        fast_import_release_point(stream, wd, rp1, rp2, results)
+
+# A batch file has one release point per line: rp1, rp2, the path to its ZIP,
+# and then any titles that are known to be corrupt and must be skipped.
+# Blank lines and lines starting with # are ignored.
+def read_batch_file(path):
+    entries = []
+    f = open(path, 'r')
+    for line in f:
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        parts = line.split()
+        if len(parts) < 3:
+            print u"(FATAL) #### Bad batch file line: " + line
+            assert(False)
+            sys.exit(2)
+        entries.append((parts[0], parts[1], parts[2], parts[3:]))
+    f.close()
+    return entries
+
+def run_batch_command(command, env, result):
+    result.append(subprocess.call(command, shell=True, env=env))
+
+# Processes many release points with one long-lived pool. Each release point
+# gets its own directory under <wd>/rp/ so that the batch command (for example
+# the commit steps of fullset.sh) can work on release point N while the pool is
+# already rendering N+1. The manifest and the section cache are shared.
+def process_batch(path, titles, notice, wd, options, args, stream=None):
+    entries = read_batch_file(path)
+    pool = Pool(max(1, args.jobs))
+    hook = None
+    hookresult = []
+    lastwd = None
+    for idx, entry in enumerate(entries):
+        rp1, rp2, zippath, failed = entry
+        rpwd = wd + '/rp/' + rp1 + '-' + rp2
+        at = titles
+        if not at:
+            at = ALL_TITLES
+        at = [t for t in at if not (t in failed)]
+        print "Starting release point " + rp1 + "-" + rp2 + " (" + str(idx + 1) + " of " + str(len(entries)) + ")"
+        zipinfo = process_zip(open(zippath, 'rb'), rpwd)
+        prep_output(rpwd)
+        process_release_point(pool, zipinfo, rp1, rp2, notice, rpwd, at, options, args, stream)
+        print "Finished release point " + rp1 + "-" + rp2
+        if hook:
+            hook.join()
+            if hookresult[-1] != 0:
+                print u"(FATAL) #### Batch command failed for the previous release point; stopping"
+                assert(False)
+                sys.exit(2)
+            # Its output has been consumed, and anything it could be copied
+            # forward from has been copied by now.
+            shutil.rmtree(lastwd)
+            hook = None
+        if args.batch_command:
+            env = dict(os.environ)
+            env['USCRP1'] = rp1
+            env['USCRP2'] = rp2
+            env['USCTITLES'] = ' '.join(at)
+            env['USCFAILEDTITLES'] = ' '.join(failed)
+            env['USCGENDIR'] = os.path.abspath(rpwd + '/gen')
+            env['USCBATCHINDEX'] = str(idx + 1)
+            hook = threading.Thread(target=run_batch_command, args=(args.batch_command, env, hookresult))
+            hook.start()
+            lastwd = rpwd
+    if hook:
+        hook.join()
+        if hookresult[-1] != 0:
+            print u"(FATAL) #### Batch command failed for the last release point"
+            assert(False)
+            sys.exit(2)
+    pool.close()
+    pool.join()
 
 def main():
     parser = argparse.ArgumentParser(description='Generates publicdocs project US Code files.')
@@ -905,25 +2962,103 @@ def main():
                         help='Second part of the release point id, ex. 195 in Public Law 114-195')
     parser.add_argument('--titles', dest='titles', nargs='*',
                         help='List of title numbers to process, or none to process all')
+    parser.add_argument('--stream', dest='streaming', action='store_true',
+                        help='parse and write each title incrementally, so memory use follows the largest section rather than the largest title')
+    parser.add_argument('--incremental', dest='incremental', action='store_true',
+                        help='keep the output of titles whose XML is unchanged since the last run, and only refresh their README.md')
+    parser.add_argument('--section-cache', dest='section_cache', action='store_true',
+                        help='reuse the rendering of sections whose XML is unchanged since the last run, and only rewrite files whose bytes differ; implies --stream')
+    parser.add_argument('--jobs', '-j', dest='jobs', action='store', type=int,
+                        default=cpu_count(),
+                        help='number of titles to process at once; defaults to the number of cores')
+    parser.add_argument('--max-memory', dest='max_memory', action='store', type=int,
+                        help='only start titles while their estimated memory, with that of the titles running, fits in this many MB')
+    parser.add_argument('--batch', dest='batch_file', action='store',
+                        help='path to a file listing release points to process in one run, see read_batch_file')
+    parser.add_argument('--batch-command', dest='batch_command', action='store',
+                        help='shell command run for each release point of a --batch once its titles are done, while the next one is processed')
+    parser.add_argument('--report-dir', dest='report_dir', action='store',
+                        help='directory for the JSON run report of each release point; defaults to reports/ in the working directory')
+    parser.add_argument('--profile', dest='profile_dir', action='store',
+                        help='profile every title in its worker, saving the profiles to <dir>/<rp1>-<rp2>/')
+    parser.add_argument('--profile-mode', dest='profile_mode', action='store', choices=['cprofile', 'sample'], default='cprofile',
+                        help='cprofile for deterministic profiles (.prof), or sample for stack samples every 5ms of CPU time (.stacks)')
+    parser.add_argument('--profile-merge', dest='profile_merge', action='store',
+                        help='instead of processing, merge the profiles under this directory and print the top functions')
+    parser.add_argument('--fast-import', dest='fast_import', action='store',
+                        help='also write the generated titles as a git fast-import stream to this file, one commit per title')
+    parser.add_argument('--fast-import-git-dir', dest='fast_import_git_dir', action='store',
+                        help='feed the git fast-import stream straight into the repository at this git directory')
+    parser.add_argument('--fast-import-branch', dest='fast_import_branch', action='store', default='master',
+                        help='branch the fast-import commits go to')
+    parser.add_argument('--fast-import-from', dest='fast_import_from', action='store',
+                        help='parent of the first fast-import commit; defaults to the current tip of the branch, use none for a root commit')
+    parser.add_argument('--fast-import-prefix', dest='fast_import_prefix', action='store', default='assets/md/titles/',
+                        help='path of the titles in the repository')
+    parser.add_argument('--fast-import-committer', dest='fast_import_committer', action='store',
+                        default='uscode-software <uscode-software@users.noreply.github.com>',
+                        help='committer of the fast-import commits, as Name <email>')
+    parser.add_argument('--write-queue', dest='write_queue', action='store', type=int, default=64,
+                        help='write the files of each title in a thread of its own, with up to this many files waiting; 0 writes them as they are rendered')
+    parser.add_argument('--dedupe-links', dest='dedupe_links', action='store_true',
+                        help='write each link definition once per file, instead of once per reference')
+    parser.add_argument('--parser', dest='parser', action='store', choices=['auto'] + XML_PARSERS, default='auto',
+                        help='XML parser; auto picks the first of ' + ', '.join(XML_PARSERS) + ' that is installed')
+    parser.add_argument('--ir-cache', dest='ir_cache', action='store_true',
+                        help='save what is written for each title in the cache directory, and write titles whose XML and rendering code are unchanged from there without parsing them')
+    parser.add_argument('--xref-index', dest='xref_index', action='store',
+                        help='index the files generated for the identifiers of all titles in this database, and link references to them within the repository instead of through the redirector')
+    parser.add_argument('--section', dest='sections', nargs='+',
+                        help='instead of processing whole titles, write again only the files of the divisions or sections with these USLM identifiers, using an index of where they are in the title XML')
+    parser.add_argument('--manifest-dir', dest='manifest_dir', action='store',
+                        help='directory of the build manifest used by --incremental; defaults to manifest/ in the working directory')
+    parser.add_argument('--compare-manifest', dest='compare_manifest', action='store',
+                        help='instead of processing, compare the build manifest in this directory with the one in --manifest-dir, printing for each title: the title, unchanged/metadata/content/new, and the numbers of changed, added and removed files')
 
     args = parser.parse_args()
-    if args.input_zip:
+    manifest_dir = args.manifest_dir
+    if not manifest_dir:
+        manifest_dir = args.working_directory + '/manifest'
+    report_dir = args.report_dir
+    if not report_dir:
+        report_dir = args.working_directory + '/reports'
+    options = TitleOptions(streaming = args.streaming, incremental = args.incremental, manifest_dir = manifest_dir,
+            cache_dir = args.working_directory + '/cache', report_dir = report_dir, section_cache = args.section_cache,
+            profile_dir = args.profile_dir, profile_mode = unicode(args.profile_mode), write_queue = args.write_queue,
+            dedupe_links = args.dedupe_links, xref_index = args.xref_index, ir_cache = args.ir_cache)
+    if args.parser != 'auto':
+        options = options._replace(parser = args.parser)
+    print "Parsing XML with " + use_xml_backend(options.parser).name
+    stream = None
+    if args.fast_import or args.fast_import_git_dir:
+        options = options._replace(fast_import_prefix = unicode(args.fast_import_prefix))
+        parent = args.fast_import_from
+        if parent is None:
+            parent = u'refs/heads/' + args.fast_import_branch + u'^0'
+        elif parent == u'none':
+            parent = None
+        stream = fast_import_stream(args.fast_import, args.fast_import_git_dir, unicode(args.fast_import_branch), parent, unicode(args.fast_import_committer))
+    if args.profile_merge:
+        merge_profiles(args.profile_merge)
+    elif args.compare_manifest:
+        compare_manifests(args.compare_manifest, manifest_dir, args.titles)
+    elif args.sections:
+        zipinfo = process_zip(args.input_zip, args.working_directory, digest=False)
+        for identifier in args.sections:
+            process_section(zipinfo, identifier, args.rp1, args.rp2, args.working_directory, options)
+    elif args.batch_file:
+        notice = args.notice_file.read()
+        process_batch(args.batch_file, args.titles, notice, args.working_directory, options, args, stream)
+    elif args.input_zip:
         zipinfo = process_zip(args.input_zip, args.working_directory)
         notice = args.notice_file.read()
         prep_output(args.working_directory)
-        at = args.titles
-        if not at:
-            at = sorted("01 02 03 04 05 06 07 08 09 10 11 12 13 14 15 16 17 18 19 20 21 22 23 24 25 26 27 28 29 30 31 32 33 34 35 36 37 38 39 40 41 42 43 44 45 46 47 48 49 50 51 52 53 54 55 56 57 58 59 60 05A 11A 18A 28a 50A".split())
-        if len(at) > 1:
-            pool = Pool(len(at))
-            tp = title_processor(zipinfo, args.rp1, args.rp2, notice, args.working_directory)
-            pool.map(tp, at)
-        else:
-            for title in at:
-                process_title(zipinfo, title, args.rp1, args.rp2, notice, args.working_directory)
+        process_release_point(None, zipinfo, args.rp1, args.rp2, notice, args.working_directory, args.titles, options, args, stream)
     else:
         print u"(FATAL) #### Could not determine operating mode"
         assert(False)
+    if stream:
+        stream.close()
 
 if __name__ == "__main__":
     main()
@@ -6,6 +6,9 @@
 
 USC_SW_VER=$(git --git-dir=../uscode-software/.git rev-parse HEAD)
 
+# process_xml.py --batch points this at the output of each release point.
+USCGENDIR=${USCGENDIR:-../uscode-software/working/gen}
+
 
 
 # for each title:
@@ -40,13 +43,13 @@ Generated with https://github.com/publicdocs/uscode-software/tree/$USC_SW_VER" |
 USCMDONLY=" "
 for USCNUM in $USCCURTITLES
 do
-  if [ -e assets/md/titles/usc$USCNUM/us ] || [ -e ../uscode-software/working/gen/titles/usc$USCNUM/us ] ; then
-    git diff --exit-code --quiet --no-index assets/md/titles/usc$USCNUM/us ../uscode-software/working/gen/titles/usc$USCNUM/us
+  if [ -e assets/md/titles/usc$USCNUM/us ] || [ -e $USCGENDIR/titles/usc$USCNUM/us ] ; then
+    git diff --exit-code --quiet --no-index assets/md/titles/usc$USCNUM/us $USCGENDIR/titles/usc$USCNUM/us
     if [ $? -eq 0 ] ; then
       echo P1 Skipping $USCNUM for now - no content difference.
       USCMDONLY="$USCMDONLY $USCNUM"
     else
-      USCDIFFSTAT=$(git diff --shortstat --no-index assets/md/titles/usc$USCNUM/us ../uscode-software/working/gen/titles/usc$USCNUM/us | sed -e 's/ changed//g' | sed -e 's/insertions//g' | sed -e 's/insertion//g' | sed -e 's/deletions//g' | sed -e 's/deletion//g' | tr '\n' ' ')
+      USCDIFFSTAT=$(git diff --shortstat --no-index assets/md/titles/usc$USCNUM/us $USCGENDIR/titles/usc$USCNUM/us | sed -e 's/ changed//g' | sed -e 's/insertions//g' | sed -e 's/insertion//g' | sed -e 's/deletions//g' | sed -e 's/deletion//g' | tr '\n' ' ')
       if [ "z-$USCDIFFSTAT-z" = 'z- 1 file, 1 (+), 1 (-) -z' ]; then
         echo P1 Minor Content difference for $USCNUM - skipping until end.
         git reset --hard HEAD
@@ -54,7 +57,7 @@ do
       else
         rm -rf assets/md/titles/usc$USCNUM
         mkdir assets/md/titles/usc$USCNUM
-        cp -R ../uscode-software/working/gen/titles/usc$USCNUM assets/md/titles
+        cp -R $USCGENDIR/titles/usc$USCNUM assets/md/titles
         git add -A .
         echo P1 Major Content difference for $USCNUM - committing.
         git commit -m "(Rel $USCRP1-$USCRP2) $USCNUM U.S.C. :$USCDIFFSTAT
@@ -69,11 +72,11 @@ done
 
 for USCNUM in $USCMDONLY
 do
-  if [ -e assets/md/titles/usc$USCNUM/us ] || [ -e ../uscode-software/working/gen/titles/usc$USCNUM/us ] ; then
+  if [ -e assets/md/titles/usc$USCNUM/us ] || [ -e $USCGENDIR/titles/usc$USCNUM/us ] ; then
     echo P2 Metadata update $USCNUM
     rm -rf assets/md/titles/usc$USCNUM
     mkdir assets/md/titles/usc$USCNUM
-    cp -R ../uscode-software/working/gen/titles/usc$USCNUM assets/md/titles
+    cp -R $USCGENDIR/titles/usc$USCNUM assets/md/titles
   else
     echo P2 No such title $USCNUM
   fi